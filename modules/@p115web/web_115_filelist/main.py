@@ -75,9 +75,10 @@ from functools import partial, update_wrapper
 from os import stat
 from os.path import dirname, expanduser, join as joinpath, realpath
 from sys import exc_info
+from time import monotonic
 from urllib.parse import quote
 
-from cachetools import LRUCache, TTLCache
+from cachetools import LRUCache
 from blacksheep import (
     route, text, html, file, redirect, 
     Application, Content, Request, Response, StreamedContent
@@ -144,7 +145,9 @@ fs = client.get_fs(client, path_to_id=LRUCache(65536))
 # NOTE: id 到 pickcode 的映射
 id_to_pickcode: MutableMapping[int, str] = LRUCache(65536)
 # NOTE: 有些播放器，例如 IINA，拖动进度条后，可能会有连续 2 次请求下载链接，而后台请求一次链接大约需要 170-200 ms，因此弄个 0.3 秒的缓存
-url_cache: MutableMapping[tuple[str, str], P115URL] = TTLCache(64, ttl=0.3)
+url_cache: dict[tuple[str, str], tuple[float, P115URL]] = {}
+url_cache_ttl = 0.3
+url_cache_size = 64
 
 
 app = Application()
@@ -503,15 +506,21 @@ async def get_url(
     user_agent = (request.get_first_header(b"User-agent") or b"").decode("utf-8")
     if not pickcode:
         pickcode = await call_wrap(fs.get_pickcode, (path or path2) if id < 0 else id)
-    try:
-        url = url_cache[(pickcode, user_agent)]
-    except KeyError:
-        url = url_cache[(pickcode, user_agent)] = await call_wrap(
+    key = (pickcode, user_agent)
+    if (item := url_cache.get(key)) and monotonic() - item[0] < url_cache_ttl:
+        url = item[1]
+    else:
+        url = await call_wrap(
             fs.get_url_from_pickcode, 
             pickcode, 
             headers={"User-Agent": user_agent}, 
             use_web_api=web, 
         )
+        now = monotonic()
+        url_cache[key] = (now, url)
+        if len(url_cache) > url_cache_size:
+            for k in [k for k, (t, _) in url_cache.items() if now - t >= url_cache_ttl]:
+                del url_cache[k]
     return {"url": url, "headers": url["headers"]}
 
 
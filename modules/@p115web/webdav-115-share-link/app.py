@@ -107,7 +107,7 @@ def _init_config():
 
     cookies: None | str
     try:
-        cookies = open(cookies_path, encoding="latin-1").read().strip()
+        cookies = open(cookies_path, "rb", buffering=0).read().decode("latin-1").strip()
     except FileNotFoundError:
         cookies = None
 
@@ -250,7 +250,7 @@ class P115ShareFilesystemProvider(DAVProvider):
 
     @classmethod
     def from_config_file(cls, cookies_path, config_path, wsgidav_config_path=None, /, watch: bool = False):
-        cookies_text = open(cookies_path, "r", encoding="latin-1").read()
+        cookies_text = open(cookies_path, "rb", buffering=0).read().decode("latin-1")
         config_text = open(config_path, "rb", buffering=0).read()
 
         if not watch:
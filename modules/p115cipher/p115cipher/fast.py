@@ -28,10 +28,13 @@ def rsa_encode(data: Buffer, /) -> bytes:
     xor_text = bytearray(16)
     tmp = memoryview(xor(data, b"\x8d\xa5\xa5\x8d"))[::-1]
     xor_text += xor(tmp, b"x\x06\xadL3\x86]\x18L\x01?F")
-    cipher_data = bytearray()
     view = memoryview(xor_text)
+    cipher_data = bytearray(((len(view) + 116) // 117) << 7)
+    i = 0
     for l, r, _ in acc_step(0, len(view), 117):
-        cipher_data += to_bytes(pow(pad_pkcs1_v1_5(view[l:r]), RSA_PUBKEY_PAIR[1], RSA_PUBKEY_PAIR[0]), 128)
+        j = i + 128
+        cipher_data[i:j] = to_bytes(pow(pad_pkcs1_v1_5(view[l:r]), RSA_PUBKEY_PAIR[1], RSA_PUBKEY_PAIR[0]), 128)
+        i = j
     return b64encode(cipher_data)
 
 
@@ -712,10 +712,7 @@ LIMIT 1;""", (share_code, id))
             if remains:
                 mtime_groups: dict[int, dict[str, AttrDict]] = {}
                 for a in children:
-                    try:
-                        mtime_groups[a["mtime"]][a["id"]] = a
-                    except KeyError:
-                        mtime_groups[a["mtime"]] = {a["id"]: a}
+                    mtime_groups.setdefault(a["mtime"], {})[a["id"]] = a
                 his_it = iter(sorted(mtime_groups.items(), reverse=True))
                 his_mtime, his_items = next(his_it)
             try:
@@ -8,18 +8,22 @@ __license__ = "GPLv3 <https://www.gnu.org/licenses/gpl-3.0.txt>"
 
 import logging
 
+from asyncio import create_task, shield, sleep, CancelledError, Task
 from collections.abc import Buffer, Callable, Mapping
+from contextlib import suppress
 from errno import EIO, ENOENT
 from hashlib import sha1 as calc_sha1
+from hmac import compare_digest
 from http import HTTPStatus
 from itertools import cycle
+from os import stat, PathLike
 from re import compile as re_compile
-from string import digits, hexdigits
+from string import digits
 from time import time
 from typing import cast, Any, Final, Self
 from urllib.parse import parse_qsl, quote, urlencode, unquote, urlsplit, urlunsplit
 
-from blacksheep import json, text, Application, FromJSON, Request, Response, Router
+from blacksheep import text, Application, FromJSON, Request, Response, Router
 from blacksheep.client import ClientSession
 from blacksheep.contents import Content, FormContent
 from blacksheep.exceptions import HTTPException
@@ -36,6 +40,7 @@ from uvicorn.config import LOGGING_CONFIG
 
 
 CRE_COOKIES_UID_search: Final = re_compile(r"(?<=\bUID=)[^\s;]+").search
+CRE_sha1_fullmatch: Final = re_compile("[0-9a-fA-F]{40}").fullmatch
 CRE_name_search: Final = re_compile(r"[^&=]+(?=&|$)").match
 
 LOGGING_CONFIG["formatters"]["default"]["fmt"] = "[\x1b[1m%(asctime)s\x1b[0m] %(levelprefix)s %(message)s"
@@ -88,6 +93,10 @@ def get_first(m: Mapping, *keys, default=None):
     return default
 
 
+def json_response(obj, /, status: int = 200) -> Response:
+    return Response(status, None, Content(b"application/json", dumps(obj)))
+
+
 def get_user_id_from_cookies(cookies: str, /) -> int:
     match = CRE_COOKIES_UID_search(cookies)
     if match is None:
@@ -95,6 +104,11 @@ def get_user_id_from_cookies(cookies: str, /) -> int:
     return int(match[0].partition("_")[0])
 
 
+def read_cookies(path: str | PathLike, /) -> str:
+    with open(path, "rb") as f:
+        return str(f.read().strip(), "latin-1")
+
+
 def check_response(resp: Response, /) -> Response:
     if resp.status >= 400:
         raise HTTPException(resp.status)
@@ -157,6 +171,8 @@ def make_application(
     token: str = "", 
     cache_url: bool = False, 
     cache_size: int = 65536, 
+    cookies_path: str | PathLike = "", 
+    cookies_check_interval: float = 5, 
 ) -> Application:
     ID_TO_PICKCODE:   LRUDict[tuple[int, int], str] = LRUDict(cache_size)
     SHA1_TO_PICKCODE: LRUDict[tuple[int, str], str] = LRUDict(cache_size)
@@ -169,11 +185,35 @@ def make_application(
     DOWNLOAD_URL_CACHE1: TLRUDict[tuple[int, str] | tuple[str, int], Url] = TLRUDict(cache_size)
     DOWNLOAD_URL_CACHE2: TLRUDict[tuple[int, str, str], Url] = TLRUDict(1024)
     RECEIVE_CODE_MAP: dict[str, str] = {}
+    DOWNLOAD_URL_INFLIGHT: dict[tuple[int, str, str, str], Task[Url]] = {}
+    sha1_to_pickcode_get = SHA1_TO_PICKCODE.get
+    sha1_to_pickcode_set = SHA1_TO_PICKCODE.__setitem__
+    receive_code_get = RECEIVE_CODE_MAP.get
 
     PASSWORD = password
     d_cookies = {ick: ck for ck in cookies.split("\n") if (ick := get_user_id_from_cookies(ck))}
+    d_headers = {ick: {"Cookie": ck} for ick, ck in d_cookies.items()}
     client: ClientSession
 
+    def update_cookies(cookies: str, /):
+        d_cookies.update((ick, ck) for ck in cookies.split("\n") if (ick := get_user_id_from_cookies(ck)))
+        d_headers.update((ick, {"Cookie": ck}) for ick, ck in d_cookies.items())
+
+    # NOTE: 未设置 token 时，check_sign 为 None，请求时直接跳过签名检查
+    if token:
+        sign_hasher = calc_sha1(bytes(f"302@115-{token}-", "utf-8"))
+
+        def check_sign(value, sign: str, t: int, /) -> None | Response:
+            hasher = sign_hasher.copy()
+            hasher.update(bytes(f"{t}-{value}", "utf-8"))
+            if not (sign.isascii() and compare_digest(sign, hasher.hexdigest())):
+                return json_response({"state": False, "message": "invalid sign"}, 403)
+            elif t > 0 and t <= time():
+                return json_response({"state": False, "message": "url was expired"}, 401)
+            return None
+    else:
+        check_sign = None
+
     app = Application(router=Router(), show_error_details=debug)
     logger = getattr(app, "logger")
     handler = logging.StreamHandler()
@@ -210,6 +250,32 @@ def make_application(
             app.services.register(ClientSession, instance=client)
             yield
 
+    if cookies_path:
+        @app.lifespan
+        async def watch_cookies_file():
+            async def watch():
+                try:
+                    cookies_mtime = stat(cookies_path).st_mtime
+                except OSError:
+                    cookies_mtime = 0
+                while True:
+                    await sleep(cookies_check_interval)
+                    try:
+                        mtime = stat(cookies_path).st_mtime
+                        if mtime > cookies_mtime:
+                            update_cookies(read_cookies(cookies_path))
+                            cookies_mtime = mtime
+                            logger.info(f"cookies reloaded from {cookies_path!r}")
+                    except Exception as e:
+                        logger.warning(f"failed to reload cookies from {cookies_path!r}: {type(e).__qualname__}: {e}")
+            task = create_task(watch())
+            try:
+                yield
+            finally:
+                task.cancel()
+                with suppress(CancelledError):
+                    await task
+
     @app.middlewares.append
     async def access_log(request: Request, handler) -> Response:
         start_t = time()
@@ -268,12 +334,12 @@ def make_application(
 
     async def get_pickcode_to_id(id: int, user_id: int = 0) -> str:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
         if pickcode := ID_TO_PICKCODE.get((user_id, id), ""):
             return pickcode
-        resp = await client.get(f"http://web.api.115.com/files/file?file_id={id}", headers={"Cookie": cookies})
+        resp = await client.get(f"http://web.api.115.com/files/file?file_id={id}", headers=headers)
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
         if not (json and json["state"]):
@@ -283,17 +349,18 @@ def make_application(
 
     async def get_pickcode_for_sha1(sha1: str, user_id: int = 0) -> str:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
-        if pickcode := SHA1_TO_PICKCODE.get((user_id, sha1), ""):
+            user_id, headers = next(iter(d_headers.items()))
+        if pickcode := sha1_to_pickcode_get((user_id, sha1), ""):
             return pickcode
-        resp = await client.get(f"http://web.api.115.com/files/shasearch?sha1={sha1}", headers={"Cookie": cookies})
+        resp = await client.get(f"http://web.api.115.com/files/shasearch?sha1={sha1}", headers=headers)
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
         if not (json and json["state"]):
             raise FileNotFoundError(ENOENT, json)
-        pickcode = SHA1_TO_PICKCODE[(user_id, sha1)] = json["data"]["pick_code"]
+        pickcode = json["data"]["pick_code"]
+        sha1_to_pickcode_set((user_id, sha1), pickcode)
         return pickcode
 
     async def get_pickcode_for_path(
@@ -305,9 +372,9 @@ def make_application(
         ).__next__, 
     ) -> str:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
         path = "/" + path.strip("/")
         dir_, _, name = path.rpartition("/")
         if not name:
@@ -316,7 +383,7 @@ def make_application(
             if refresh or not (parent_id := DIR_TO_CID.get((user_id, dir_), 0)):
                 resp = await client.get(
                     f"{get_base_url()}/files/getid?{urlencode({'path': dir_})}", 
-                    headers={"Cookie": cookies}, 
+                    headers=headers, 
                 )
                 check_response(resp)
                 json = loads(cast(bytes, await resp.read()))
@@ -339,9 +406,9 @@ def make_application(
         refresh: None | bool = False, 
     ) -> str:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
         if refresh is False and (pickcode := NAME_TO_PICKCODE.get((user_id, name), "")):
             return pickcode
         api = "http://web.api.115.com/files/search"
@@ -349,12 +416,12 @@ def make_application(
         suffix = name.rpartition(".")[-1]
         if suffix.isalnum():
             payload["suffix"] = suffix
-        resp = await client.get(f"{api}?{urlencode(payload)}", headers={"Cookie": cookies})
+        resp = await client.get(f"{api}?{urlencode(payload)}", headers=headers)
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
         if get_first(json, "errno", "errNo") == 20021:
             payload.pop("suffix")
-            resp = await client.get(f"{api}?{urlencode(payload)}", headers={"Cookie": cookies})
+            resp = await client.get(f"{api}?{urlencode(payload)}", headers=headers)
             check_response(resp)
             json = loads(cast(bytes, await resp.read()))
         if not json["state"] or not json["count"]:
@@ -376,9 +443,9 @@ def make_application(
         refresh: None | bool = False, 
     ) -> int:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
         if refresh is False and (id := SHARE_NAME_TO_ID.get((share_code, name), 0)):
             return id
         api = "http://web.api.115.com/share/search"
@@ -393,12 +460,12 @@ def make_application(
         suffix = name.rpartition(".")[-1]
         if suffix.isalnum():
             payload["suffix"] = suffix
-        resp = await client.get(f"{api}?{urlencode(payload)}", headers={"Cookie": cookies})
+        resp = await client.get(f"{api}?{urlencode(payload)}", headers=headers)
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
         if get_first(json, "errno", "errNo") == 20021:
             payload.pop("suffix")
-            resp = await client.get(f"{api}?{urlencode(payload)}", headers={"Cookie": cookies})
+            resp = await client.get(f"{api}?{urlencode(payload)}", headers=headers)
             check_response(resp)
             json = loads(cast(bytes, await resp.read()))
         if not json["state"] or not json["data"]["count"]:
@@ -418,25 +485,54 @@ def make_application(
         user_id: int = 0, 
     ) -> Url:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
+        key = (user_id, pickcode, user_agent, app)
         if (cache_url and (r := DOWNLOAD_URL_CACHE.get((user_id, pickcode, user_agent)))
             or (r := DOWNLOAD_URL_CACHE1.get((user_id, pickcode)))
             or (r := DOWNLOAD_URL_CACHE2.get((user_id, pickcode, user_agent)))
         ):
-            return r[1]
+            expire_ts, url = r
+            # NOTE: 链接即将过期时，先返回缓存，并在后台提前刷新
+            if expire_ts - time() < 60 and key not in DOWNLOAD_URL_INFLIGHT:
+                start_request_downurl(key, headers)
+            return url
+        # NOTE: 合并并发的相同请求，只向 115 发出 1 次
+        if not (task := DOWNLOAD_URL_INFLIGHT.get(key)):
+            task = start_request_downurl(key, headers)
+        return await shield(task)
+
+    def start_request_downurl(key: tuple[int, str, str, str], headers: dict[str, str], /) -> Task[Url]:
+        user_id, pickcode, user_agent, app = key
+        task = DOWNLOAD_URL_INFLIGHT[key] = create_task(
+            request_downurl(pickcode, user_agent, app=app, user_id=user_id, headers=headers))
+        def done(task, /):
+            DOWNLOAD_URL_INFLIGHT.pop(key, None)
+            # NOTE: 后台刷新的任务无人等待，失败时记录日志，以免异常被静默吞掉
+            if not task.cancelled() and (exc := task.exception()) is not None:
+                logger.warning(f"failed to request download url for {key!r}: {type(exc).__qualname__}: {exc}", exc_info=exc)
+        task.add_done_callback(done)
+        return task
+
+    async def request_downurl(
+        pickcode: str, 
+        user_agent: str, 
+        app: str, 
+        user_id: int, 
+        headers: dict[str, str], 
+    ) -> Url:
         if app == "chrome":
             resp = await client.post(
                 "http://proapi.115.com/app/chrome/downurl", 
                 content=FormContent([("data", encrypt(f'{{"pickcode":"{pickcode}"}}').decode("utf-8"))]), 
-                headers={"User-Agent": user_agent, "Cookie": cookies}, 
+                headers={**headers, "User-Agent": user_agent}, 
             )
         else:
             resp = await client.post(
                 f"http://proapi.115.com/{app or 'android'}/2.0/ufile/download", 
                 content=FormContent([("data", encrypt(f'{{"pick_code":"{pickcode}"}}').decode("utf-8"))]), 
-                headers={"User-Agent": user_agent, "Cookie": cookies}, 
+                headers={**headers, "User-Agent": user_agent}, 
             )
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
@@ -469,22 +565,22 @@ def make_application(
         user_id: int = 0, 
     ) -> Url:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
+            user_id, headers = next(iter(d_headers.items()))
         if r := DOWNLOAD_URL_CACHE1.get((share_code, file_id)):
             return r[1]
         payload = {"share_code": share_code, "receive_code": receive_code, "file_id": file_id}
         if app:
             resp = await client.get(
                 f"http://proapi.115.com/{app}/2.0/share/downurl?{urlencode(payload)}", 
-                headers={"Cookie": cookies}, 
+                headers=headers, 
             )
         else:
             resp = await client.post(
                 f"http://proapi.115.com/app/share/downurl", 
                 content=FormContent([("data", encrypt(dumps(payload)).decode("utf-8"))]), 
-                headers={"Cookie": cookies}, 
+                headers=headers, 
             )
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
@@ -510,14 +606,14 @@ def make_application(
 
     async def get_receive_code(share_code: str, user_id: int = 0) -> str:
         if user_id:
-            cookies = d_cookies[user_id]
+            headers = d_headers[user_id]
         else:
-            user_id, cookies = next(iter(d_cookies.items()))
-        if receive_code := RECEIVE_CODE_MAP.get(share_code, ""):
+            user_id, headers = next(iter(d_headers.items()))
+        if receive_code := receive_code_get(share_code, ""):
             return receive_code
         resp = await client.get(
             f"http://web.api.115.com/share/shareinfo?share_code={share_code}", 
-            headers={"Cookie": cookies}, 
+            headers=headers, 
         )
         check_response(resp)
         json = loads(cast(bytes, await resp.read()))
@@ -544,16 +640,9 @@ def make_application(
         sign: str = "", 
         t: int = 0, 
     ):
-        def check_sign(value, /):
-            if not token:
-                return None
-            if sign != calc_sha1(bytes(f"302@115-{token}-{t}-{value}", "utf-8")).hexdigest():
-                return json({"state": False, "message": "invalid sign"}, 403)
-            elif t > 0 and t <= time():
-                return json({"state": False, "message": "url was expired"}, 401)
         file_name = name or name2
         if share_code:
-            if resp := check_sign(id if id else file_name):
+            if check_sign and (resp := check_sign(id if id else file_name, sign, t)):
                 return resp
             if not receive_code:
                 receive_code = await get_receive_code(share_code, user_id=user_id)
@@ -567,18 +656,18 @@ def make_application(
             url = await get_share_downurl(share_code, receive_code, id, app=app, user_id=user_id)
         else:
             if pickcode:
-                if resp := check_sign(pickcode):
+                if check_sign and (resp := check_sign(pickcode, sign, t)):
                     return resp
                 if not (len(pickcode) == 17 and pickcode.isalnum()):
                     raise ValueError(f"bad pickcode: {pickcode!r}")
             elif id:
-                if resp := check_sign(id):
+                if check_sign and (resp := check_sign(id, sign, t)):
                     return resp
                 pickcode = await get_pickcode_to_id(id, user_id=user_id)
             elif sha1:
-                if resp := check_sign(sha1):
+                if check_sign and (resp := check_sign(sha1, sign, t)):
                     return resp
-                if len(sha1) != 40 or sha1.strip(hexdigits):
+                if not CRE_sha1_fullmatch(sha1):
                     raise ValueError(f"bad sha1: {sha1!r}")
                 pickcode = await get_pickcode_for_sha1(sha1.upper(), user_id=user_id)
             else:
@@ -588,13 +677,13 @@ def make_application(
                 elif not name and (idx := file_name.find("/")) > 0:
                     file_name, remains = file_name[:idx], file_name[idx:]
                 if file_name:
-                    if resp := check_sign(file_name + remains):
+                    if check_sign and (resp := check_sign(file_name + remains, sign, t)):
                         return resp
                     if len(file_name) == 17 and file_name.isalnum():
                         pickcode = file_name.lower()
                     elif not file_name.strip(digits):
                         pickcode = await get_pickcode_to_id(int(file_name), user_id=user_id)
-                    elif len(file_name) == 40 and not file_name.strip(hexdigits):
+                    elif CRE_sha1_fullmatch(file_name):
                         pickcode = await get_pickcode_for_sha1(file_name.upper(), user_id=user_id)
                     elif is_path:
                         pickcode = await get_pickcode_for_path(file_name + remains, user_id=user_id, refresh=refresh)
@@ -618,8 +707,8 @@ def make_application(
             :param password: 口令
             """
             if PASSWORD != password:
-                return json({"state": False, "message": "password does not match"}, 401)
-            return json({"state": True, "cookies": "\n".join(d_cookies.values())})
+                return json_response({"state": False, "message": "password does not match"}, 401)
+            return json_response({"state": True, "cookies": "\n".join(d_cookies.values())})
 
         @app.router.route("/%3Ccookies", methods=["POST"])
         async def set_cookies(request: Request, password: str = "", body: None | FromJSON[dict] = None):
@@ -629,14 +718,14 @@ def make_application(
             :param body: 请求体为 json 格式 <code>{"cookies"&colon; "新的 cookies"}</code>
             """
             if PASSWORD != password:
-                return json({"state": False, "message": "password does not match"}, 401)
+                return json_response({"state": False, "message": "password does not match"}, 401)
             if body and (cookies := body.value.get("cookies")):
                 try:
-                    d_cookies.update((ick, ck) for ck in cookies.split("\n") if (ick := get_user_id_from_cookies(ck)))
-                    return json({"state": True, "message": "ok"})
+                    update_cookies(cookies)
+                    return json_response({"state": True, "message": "ok"})
                 except Exception as e:
-                    return json({"state": False, "message": f"{type(e).__qualname__}: {e}"})
-            return json({"state": True, "message": "skip"})
+                    return json_response({"state": False, "message": f"{type(e).__qualname__}: {e}"})
+            return json_response({"state": True, "message": "skip"})
 
     return app
 
@@ -644,9 +733,9 @@ def make_application(
 if __name__ == "__main__":
     import uvicorn
 
-    cookies = open("115-cookies.txt", encoding="latin-1").read().strip()
+    cookies = read_cookies("115-cookies.txt")
     uvicorn.run(
-        make_application(cookies, debug=True), 
+        make_application(cookies, debug=True, cookies_path="115-cookies.txt"), 
         host="0.0.0.0", 
         port=8000, 
         proxy_headers=True, 
@@ -140,24 +140,32 @@ def main(argv: None | list[str] | Namespace = None, /):
     else:
         args = parse_args(argv)
 
+    from p115nano302 import make_application, read_cookies
+
     cookies = args.cookies.strip()
+    cookies_path = ""
     if not cookies:
         cookies_path = args.cookies_path.strip() or "115-cookies.txt"
-        cookies = open(cookies_path, encoding="latin-1").read().strip()
+        cookies = read_cookies(cookies_path)
 
     uvicorn_run_config_path = args.uvicorn_run_config_path
     if uvicorn_run_config_path:
-        file = open(uvicorn_run_config_path, "rb")
-        match suffix := Path(uvicorn_run_config_path).suffix.lower():
-            case ".yml" | ".yaml":
-                from yaml import load as yaml_load, Loader
-                run_config = yaml_load(file, Loader=Loader)
-            case ".toml":
-                from tomllib import load as toml_load
-                run_config = toml_load(file)
-            case _:
-                from orjson import loads as json_loads
-                run_config = json_loads(file.read())
+        from pathlib import Path
+        with open(uvicorn_run_config_path, "rb") as file:
+            match suffix := Path(uvicorn_run_config_path).suffix.lower():
+                case ".yml" | ".yaml":
+                    from yaml import load as yaml_load
+                    try:
+                        from yaml import CSafeLoader as Loader
+                    except ImportError:
+                        from yaml import SafeLoader as Loader
+                    run_config = yaml_load(file, Loader=Loader)
+                case ".toml":
+                    from tomllib import load as toml_load
+                    run_config = toml_load(file)
+                case _:
+                    from orjson import loads as json_loads
+                    run_config = json_loads(file.read())
     else:
         run_config = {}
 
@@ -168,18 +176,12 @@ def main(argv: None | list[str] | Namespace = None, /):
     if args.port:
         run_config["port"] = args.port
     elif not run_config.get("port"):
-        from socket import create_connection
-
-        def get_available_ip(start: int = 1024, stop: int = 65536) -> int:
-            for port in range(start, stop):
-                try:
-                    with create_connection(("127.0.0.1", port), timeout=1):
-                        pass
-                except OSError:
-                    return port
-            raise RuntimeError("no available ports")
+        from socket import socket
 
-        run_config["port"] = get_available_ip()
+        # NOTE: 绑定到 0 号端口，由系统分配一个空闲端口
+        with socket() as sock:
+            sock.bind(("", 0))
+            run_config["port"] = sock.getsockname()[1]
 
     run_config.setdefault("proxy_headers", True)
     run_config.setdefault("server_header", False)
@@ -187,7 +189,6 @@ def main(argv: None | list[str] | Namespace = None, /):
     run_config.setdefault("timeout_graceful_shutdown", 1)
     run_config.setdefault("access_log", False)
 
-    from p115nano302 import make_application
     from uvicorn import run
 
     print(__doc__)
@@ -197,6 +198,7 @@ def main(argv: None | list[str] | Namespace = None, /):
         password=args.password, 
         token=args.token, 
         cache_url=args.cache_url, 
+        cookies_path=cookies_path, 
     )
     run(app, **run_config)
 
@@ -5,7 +5,7 @@ __author__ = "ChenyangGao <https://chenyanggao.github.io>"
 __version__ = (0, 0, 1)
 __all__ = ["encrypt", "decrypt"]
 
-from collections.abc import Buffer, Iterator, Sized
+from collections.abc import Buffer, Sized
 from base64 import b64decode, b64encode
 from typing import Final
 
@@ -17,14 +17,6 @@ to_bytes = int.to_bytes
 from_bytes = int.from_bytes
 
 
-def acc_step(start: int, stop: int, step: int = 1) -> Iterator[tuple[int, int, int]]:
-    for i in range(start + step, stop, step):
-        yield start, i, step
-        start = i
-    if start != stop:
-        yield start, stop, stop - start
-
-
 def bytes_xor(v1: Buffer, v2: Buffer, /) -> bytes:
     return to_bytes(
         from_bytes(v1) ^ from_bytes(v2), 
@@ -58,8 +50,10 @@ def xor(src: Buffer, key: Buffer, /) -> bytearray:
     i = len(src) & 0b11
     if i:
         secret += bytes_xor(src[:i], key[:i])
-    for i, j, s in acc_step(i, len(src), len(key)):
-        secret += bytes_xor(src[i:j], key[:s])
+    step = len(key)
+    for i in range(i, len(src), step):
+        chunk = src[i:i+step]
+        secret += bytes_xor(chunk, key[:len(chunk)])
     return secret
 
 
@@ -69,18 +63,21 @@ def encrypt(data: str | Buffer, /) -> bytes:
     xor_text = bytearray(16)
     tmp = memoryview(xor(data, b"\x8d\xa5\xa5\x8d"))[::-1]
     xor_text += xor(tmp, b"x\x06\xadL3\x86]\x18L\x01?F")
-    cipher_data = bytearray()
     view = memoryview(xor_text)
-    for l, r, _ in acc_step(0, len(view), 117):
-        cipher_data += to_bytes(pow(pad_pkcs1_v1_5(view[l:r]), RSA_n, RSA_e), 128)
+    cipher_data = bytearray(((len(view) + 116) // 117) << 7)
+    i = 0
+    for l in range(0, len(view), 117):
+        j = i + 128
+        cipher_data[i:j] = to_bytes(pow(pad_pkcs1_v1_5(view[l:l+117]), RSA_n, RSA_e), 128)
+        i = j
     return b64encode(cipher_data)
 
 
 def decrypt(cipher_data: str | Buffer, /) -> bytearray:
     cipher_data = memoryview(b64decode(cipher_data))
     data = bytearray()
-    for l, r, _ in acc_step(0, len(cipher_data), 128):
-        p = pow(from_bytes(cipher_data[l:r]), RSA_n, RSA_e)
+    for l in range(0, len(cipher_data), 128):
+        p = pow(from_bytes(cipher_data[l:l+128]), RSA_n, RSA_e)
         b = to_bytes(p, (p.bit_length() + 0b111) >> 3)
         data += memoryview(b)[b.index(0)+1:]
     m = memoryview(data)
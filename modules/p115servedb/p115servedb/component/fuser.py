@@ -9,17 +9,20 @@ from . import __fuse_monkey_patch
 import errno
 import logging
 
-from collections.abc import Callable, MutableMapping
+from collections import OrderedDict
+from collections.abc import Callable, Iterator, MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import suppress
-from functools import partial
-from itertools import count
+from functools import lru_cache, partial
+from itertools import chain, islice
 from pathlib import Path
 from os import PathLike
 from posixpath import split as splitpath, splitext
 from sqlite3 import connect
 from stat import S_IFDIR, S_IFREG
 from threading import Lock
-from typing import Final, BinaryIO
+from time import time
+from typing import Final, Literal
 from unicodedata import normalize
 from weakref import WeakValueDictionary
 
@@ -40,6 +43,65 @@ from .log import logger
 
 urlopen = partial(PoolManager(num_pools=128).request, "GET", preload_content=False, timeout=5)
 
+READAHEAD_MIN: Final = 1024 * 64
+READAHEAD_MAX: Final = 1024 * 1024
+
+
+class MRUDict(OrderedDict):
+    """容量已满时淘汰最近使用的条目
+
+    .. note::
+        对于扫描整个目录树（例如 find 或媒体库索引）这类访问范围大于缓存容量的场景，LRU 的命中率会趋近于 0，而 MRU 能保留较早载入的条目
+    """
+    def __init__(self, /, maxsize: int = 0):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key, /):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value, /):
+        if key in self:
+            self.move_to_end(key)
+        elif self.maxsize > 0 and len(self) >= self.maxsize:
+            self.popitem()
+        super().__setitem__(key, value)
+
+    def update(self, other=(), /, **kwargs):
+        # NOTE: 整批插入前先一次性腾出空间，否则容量已满时，每插入一条就会淘汰刚插入的上一条，一批只能留下最后一条
+        items = dict(other, **kwargs)
+        for key in items:
+            self.pop(key, None)
+        maxsize = self.maxsize
+        if maxsize > 0:
+            if len(items) > maxsize:
+                items = dict(islice(items.items(), maxsize))
+            for _ in range(len(self) + len(items) - maxsize):
+                self.popitem()
+        setitem = super().__setitem__
+        for key, value in items.items():
+            setitem(key, value)
+
+
+@lru_cache(maxsize=8192)
+def normalize_nfc(s: str, /) -> str:
+    """对名字或路径进行 NFC 规范化（带缓存，FUSE 会反复访问相同的路径）
+    """
+    return normalize("NFC", s)
+
+
+@lru_cache(maxsize=8192)
+def normalize_split(path: str, /) -> tuple[str, str, str]:
+    """对路径进行 NFC 规范化，再分割出所在目录和名字（带缓存）
+
+    :return: 3 元组 (规范化后的路径, 所在目录, 名字)
+    """
+    normpath = normalize_nfc(path)
+    dir_, name = splitpath(normpath)
+    return normpath, dir_, name
+
 
 # Learning: 
 #   - https://www.stavros.io/posts/python-fuse-filesystem/
@@ -54,12 +116,23 @@ class ServedbFuseOperations(Operations):
         predicate: None | Callable[[MappingPath], bool] = None, 
         strm_predicate: None | Callable[[MappingPath], bool] = None, 
         strm_origin: str = "http://localhost:8000", 
+        cache_size: int = 16384, 
+        file_cache_size: int = 0, 
+        cache_policy: Literal["lru", "mru"] = "lru", 
     ):
+        # NOTE: sqlite3 模块会在连接上缓存预编译语句，这里调大容量，使 readdir 等反复执行的查询不必重新解析 SQL
         con = self.con = connect(
             dbfile, 
             check_same_thread=False, 
+            cached_statements=1024, 
             uri=isinstance(dbfile, str) and dbfile.startswith("file:"), 
         )
+        # NOTE: 数据库归 p115updatedb 所有，journal_mode 和 synchronous 由其 initdb 设置，这里只设置读取相关的 PRAGMA，
+        #       因此也可以用 "file:...?mode=ro" 以只读方式打开
+        con.executescript("""\
+PRAGMA temp_store = MEMORY;
+PRAGMA mmap_size = 268435456;
+PRAGMA cache_size = -65536;""")
         path = find(con, "SELECT file FROM pragma_database_list() WHERE name='main';")
         if path:
             dbpath = "%s-file%s" % splitext(path)
@@ -81,6 +154,27 @@ CREATE TABLE IF NOT EXISTS data (
     data BLOB
 );
 CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
+        if not find(con_file, "SELECT 1 FROM pragma_table_info('data') WHERE name='last_used'"):
+            con_file.execute("ALTER TABLE data ADD COLUMN last_used INTEGER NOT NULL DEFAULT 0")
+        # NOTE: 由触发器维护已缓存数据的总字节数，超出 file_cache_size 时，按最近使用时间淘汰
+        con_file.executescript("""\
+CREATE INDEX IF NOT EXISTS idx_last_used ON data(last_used);
+CREATE TABLE IF NOT EXISTS total (
+    id INTEGER PRIMARY KEY CHECK(id = 0),
+    size INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO total(id, size) SELECT 0, IFNULL(SUM(size), 0) FROM data;
+CREATE TRIGGER IF NOT EXISTS trg_data_insert
+AFTER INSERT ON data
+BEGIN
+    UPDATE total SET size = size + NEW.size WHERE id = 0;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_data_delete
+AFTER DELETE ON data
+BEGIN
+    UPDATE total SET size = size - OLD.size WHERE id = 0;
+END;""")
+        self.file_cache_size = file_cache_size
         self.file_lock_cache: MutableMapping[tuple[str, int], Lock] = WeakValueDictionary()
         if cookies_path:
             cookies_path = Path(cookies_path)
@@ -93,10 +187,20 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
         self.predicate = predicate
         self.strm_predicate = strm_predicate
         self.strm_origin = strm_origin
+        self._strm_prefix = strm_origin + "?pickcode="
+        self._strm_prefix_bytes = self._strm_prefix.encode("utf-8")
         self._root = {"st_mode": S_IFDIR | 0o555, "_attr": get_attr_from_db(self.con, 0)}
-        self._next_fh: Callable[[], int] = count(1).__next__
-        self._fh_to_file: dict[int, tuple[BinaryIO, bytes]] = {}
-        self.cache: LRUDict = LRUDict(1024)
+        # NOTE: 文件句柄就是 _fh_slots 的下标（0 保留不用），释放后的句柄放入 _fh_free 以便复用
+        self._fh_slots: list[None | list | Future] = [None]
+        self._fh_free: list[int] = []
+        self._fh_lock = Lock()
+        # NOTE: open 时在后台线程中打开文件并预读，首次 read 时才等待结果
+        self._io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="servedb-fuse-open")
+        cache_cls = MRUDict if cache_policy == "mru" else LRUDict
+        self.cache: MutableMapping[str, dict] = cache_cls(cache_size)
+        # NOTE: 以路径为键，缓存 readdir 时见过的目录的属性，当上级目录的列表已被淘汰时，getattr 不必再 readdir 上级目录
+        self.attr_cache: MutableMapping[str, dict] = cache_cls(cache_size)
+        # NOTE: 规范化路径 -> 以 "/" 结尾的真实路径，只记录两者不同的目录
         self.normpath_map: dict[str, str] = {}
 
     def __del__(self, /):
@@ -108,16 +212,42 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
             self.con_file.close()
             if self.client:
                 self.client.close()
-            popitem = self._fh_to_file.popitem
-            while True:
-                try:
-                    _, (file, _) = popitem()
+            self._io_pool.shutdown(wait=False, cancel_futures=True)
+            slots = self._fh_slots
+            for fh, item in enumerate(slots):
+                if item is not None:
+                    slots[fh] = None
+                    with suppress(BaseException):
+                        self._close_file(item)
+
+    @staticmethod
+    def _close_file(item: list | Future, /):
+        if isinstance(item, Future):
+            if item.cancel():
+                return
+            def callback(fu: Future, /):
+                with suppress(BaseException):
+                    file = fu.result()[0]
                     if file is not None:
                         file.close()
-                except KeyError:
-                    break
-                except:
-                    pass
+            item.add_done_callback(callback)
+        else:
+            file = item[0]
+            if file is not None:
+                file.close()
+
+    def _evict_file_cache(self, limit: int, /):
+        """淘汰最久未使用的小文件缓存，直到总字节数不超过 limit
+        """
+        con_file = self.con_file
+        if find(con_file, "SELECT size FROM total WHERE id = 0") <= limit:
+            return
+        execute(con_file, """\
+DELETE FROM data WHERE rowid IN (
+    SELECT rowid FROM (
+        SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS acc FROM data
+    ) WHERE acc > ?
+);""", limit)
 
     def getattr(
         self, 
@@ -128,10 +258,14 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
         self._log(logging.DEBUG, "getattr(path=\x1b[4;34m%r\x1b[0m, fh=%r)", path, fh)
         if path == "/":
             return self._root
-        dir_, name = splitpath(normalize("NFC", path))
+        normpath, dir_, name = normalize_split(path)
         try:
             dird = self.cache[dir_]
         except KeyError:
+            try:
+                return self.attr_cache[normpath]
+            except KeyError:
+                pass
             try:
                 self.readdir(dir_)
                 dird = self.cache[dir_]
@@ -161,11 +295,16 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
         fuse_attr = self.getattr(path)
         attr      = fuse_attr["_attr"]
         if name == "attr":
-            return json_dumps(attr)
+            # NOTE: 序列化结果缓存在 fuse_attr 上，批量读取扩展属性时不必重复序列化
+            try:
+                return fuse_attr["_attr_json"]
+            except KeyError:
+                data = fuse_attr["_attr_json"] = json_dumps(attr)
+                return data
         elif name == "url":
             if attr["is_dir"]:
                 raise IsADirectoryError(errno.EISDIR, path)
-            return json_dumps(f"{self.strm_origin}?pickcode={attr['pickcode']}")
+            return json_dumps(self._strm_prefix + attr["pickcode"])
         elif name in attr:
             return json_dumps(attr[name])
         else:
@@ -181,12 +320,21 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
 
     def open(self, /, path: str, flags: int = 0) -> int:
         self._log(logging.INFO, "open(path=\x1b[4;34m%r\x1b[0m, flags=%r)", path, flags)
-        return self._next_fh()
+        future = self._io_pool.submit(self._open, path)
+        slots = self._fh_slots
+        with self._fh_lock:
+            if self._fh_free:
+                fh = self._fh_free.pop()
+                slots[fh] = future
+            else:
+                fh = len(slots)
+                slots.append(future)
+        return fh
 
     def _open(self, path: str, /, start: int = 0):
         attr = self.getattr(path)
         if (data := attr.get("_data")) is not None:
-            return None, data
+            return [None, data]
         client = self.client
         attr_ = attr["_attr"]
         pickcode = attr_["pickcode"]
@@ -195,12 +343,19 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
         if size <= 1024 * 64:
             sha1 = attr_["sha1"]
             with self.file_lock_cache.setdefault((sha1, size), Lock()):
+                last_used = int(time())
                 data = find(
                     self.con_file, 
                     "SELECT data FROM data WHERE sha1=:sha1 AND size=:size", 
                     locals(), 
                 )
-                if data is None:
+                if data is not None:
+                    execute(
+                        self.con_file, 
+                        "UPDATE data SET last_used=:last_used WHERE sha1=:sha1 AND size=:size", 
+                        locals(), 
+                    )
+                else:
                     if client:
                         data = client.read_bytes(client.download_url(
                             pickcode, 
@@ -208,45 +363,72 @@ CREATE UNIQUE INDEX IF NOT EXISTS idx_sha1_size ON data(sha1, size);""")
                             use_web_api=use_web_api, 
                         ))
                     else:
-                        data = urlopen(f"{self.strm_origin}?pickcode={pickcode}").read()
+                        data = urlopen(self._strm_prefix + pickcode).read()
                     execute(self.con_file, """\
-INSERT INTO data(sha1, size, data) VALUES(:sha1, :size, :data) 
-ON CONFLICT DO UPDATE SET data = excluded.data;""", locals())
+INSERT INTO data(sha1, size, data, last_used) VALUES(:sha1, :size, :data, :last_used) 
+ON CONFLICT DO UPDATE SET data = excluded.data, last_used = excluded.last_used;""", locals())
+                    if (limit := self.file_cache_size) > 0:
+                        self._evict_file_cache(limit)
                 attr["_data"] = data
-                return None, data
+                return [None, data]
         if client:
             file = client.open(
                 client.download_url(pickcode, app="android", use_web_api=use_web_api), 
                 http_file_reader_cls=Urllib3FileReader, 
             )
         else:
-            file = Urllib3FileReader(f"{self.strm_origin}?pickcode={pickcode}", urlopen=urlopen)
+            file = Urllib3FileReader(self._strm_prefix + pickcode, urlopen=urlopen)
         if start == 0:
             preread = file.read(1024 * 64)
         else:
             preread = b""
-        return file, preread
+        # NOTE: [文件, 预读数据, 预读缓冲区的起点, 预读缓冲区, 下次预读的大小]
+        return [file, preread, len(preread), b"", READAHEAD_MIN]
 
     def read(self, /, path: str, size: int, offset: int, fh: int = 0) -> bytes:
         self._log(logging.DEBUG, "read(path=\x1b[4;34m%r\x1b[0m, size=%r, offset=%r, fh=%r)", path, size, offset, fh)
         if not fh:
             return b""
         try:
-            try:
-                file, preread = self._fh_to_file[fh]
-            except KeyError:
-                file, preread = self._fh_to_file[fh] = self._open(path, offset)
+            slots = self._fh_slots
+            item = slots[fh]
+            if item is None:
+                item = slots[fh] = self._open(path, offset)
+            elif isinstance(item, Future):
+                try:
+                    item = item.result()
+                except BaseException:
+                    slots[fh] = None
+                    raise
+                slots[fh] = item
+            file, preread = item[:2]
             cache_size = len(preread)
-            if file is None:
+            if file is None or offset + size <= cache_size:
                 return preread[offset:offset+size]
-            elif offset < cache_size:
-                if offset + size <= cache_size:
-                    return preread[offset:offset+size]
-                elif file is not None:
-                    file.seek(cache_size)
-                    return preread[offset:] + file.read(offset+size-cache_size)
-            file.seek(offset)
-            return file.read(size)
+            if offset < cache_size:
+                head = preread[offset:]
+                start = cache_size
+                want = offset + size - cache_size
+            else:
+                head = b""
+                start = offset
+                want = size
+            _, _, ra_start, ra_data, ra_size = item
+            ra_stop = ra_start + len(ra_data)
+            if ra_start <= start and start + want <= ra_stop:
+                return head + ra_data[start-ra_start:start-ra_start+want]
+            # NOTE: 顺序读取时，预读大小逐次翻倍（不超过 READAHEAD_MAX），否则重置
+            if ra_start <= start <= ra_stop:
+                tail = ra_data[start-ra_start:]
+                ra_size = min(ra_size << 1, READAHEAD_MAX)
+                file.seek(ra_stop)
+                data = tail + file.read(max(want - len(tail), ra_size))
+            else:
+                ra_size = READAHEAD_MIN
+                file.seek(start)
+                data = file.read(max(want, ra_size))
+            item[2:] = start, data, ra_size
+            return head + data[:want]
         except BaseException as e:
             self._log(
                 logging.ERROR, 
@@ -255,51 +437,68 @@ ON CONFLICT DO UPDATE SET data = excluded.data;""", locals())
             )
             raise OSError(errno.EIO, path) from e
 
-    def readdir(self, /, path: str, fh: int = 0) -> list[str]:
+    def readdir(
+        self, 
+        /, 
+        path: str, 
+        fh: int = 0, 
+        *, 
+        # NOTE: 循环中频繁用到的全局名字，绑定为局部变量以免每次都去查找模块的全局字典
+        _normalize: Callable[[str], str] = normalize_nfc, 
+        _MappingPath: Callable = MappingPath, 
+        _splitext: Callable = splitext, 
+        _escape: Callable[[str], str] = escape, 
+    ) -> Iterator[str]:
         self._log(logging.DEBUG, "readdir(path=\x1b[4;34m%r\x1b[0m, fh=%r)", path, fh)
         predicate = self.predicate
         strm_predicate = self.strm_predicate
-        strm_origin = self.strm_origin
-        path = normalize("NFC", path)
+        strm_prefix = self._strm_prefix_bytes
+        path = normalize_nfc(path)
         children: dict[str, dict] = {}
         self.cache[path] = children
-        realpath = self.normpath_map.get(path, path)
         try:
-            dir_ = path
-            if not dir_.endswith("/"):
-                dir_ += "/"
-            realdir = realpath
-            if not realdir.endswith("/"):
-                realdir += "/"
-            id = get_id_from_db(self.con, path=realpath+"/")
+            dir_ = path if path.endswith("/") else path + "/"
+            realdir = self.normpath_map.get(path) or dir_
+            id = get_id_from_db(self.con, path=realdir)
+            mode_dir = S_IFDIR | 0o555
+            mode_file = S_IFREG | 0o555
+            normpaths: dict[str, str] = {}
+            dir_attrs: dict[str, dict] = {}
             for attr in get_children_from_db(self.con, id):
                 data = None
                 size = attr.get("size") or 0
                 name = attr["name"]
-                normname = normalize("NFC", name.replace("/", "|"))
+                normname = _normalize(name.replace("/", "|"))
                 isdir = attr["is_dir"]
-                if not isdir and strm_predicate and strm_predicate(MappingPath(attr)):
-                    data = f"{strm_origin}?pickcode={attr['pickcode']}".encode("utf-8")
+                mpath = _MappingPath(attr) if strm_predicate or predicate else None
+                if not isdir and strm_predicate and strm_predicate(mpath):
+                    data = strm_prefix + attr["pickcode"].encode("ascii")
                     size = len(data)
-                    normname = splitext(normname)[0] + ".strm"
-                elif predicate and not predicate(MappingPath(attr)):
+                    normname = _splitext(normname)[0] + ".strm"
+                elif predicate and not predicate(mpath):
                     continue
-                children[normname] = dict(
-                    st_mode=(S_IFDIR if isdir else S_IFREG) | 0o555, 
-                    st_size=size, 
-                    st_ctime=attr["ctime"], 
-                    st_mtime=attr["mtime"], 
-                    _attr=attr, 
-                    _data=data, 
-                )
+                children[normname] = fuse_attr = {
+                    "st_mode": mode_dir if isdir else mode_file, 
+                    "st_size": size, 
+                    "st_ctime": attr["ctime"], 
+                    "st_mtime": attr["mtime"], 
+                    "_attr": attr, 
+                    "_data": data, 
+                }
                 if isdir:
                     normpath = dir_ + normname
-                    realpath = realdir + escape(name)
+                    realpath = realdir + _escape(name)
                     if normpath != realpath:
-                        self.normpath_map[normpath] = realpath
-            return [".", "..", *children]
+                        normpaths[normpath] = realpath + "/"
+                    dir_attrs[normpath] = fuse_attr
+            if normpaths:
+                self.normpath_map.update(normpaths)
+            if dir_attrs:
+                self.attr_cache.update(dir_attrs)
+            # NOTE: fusepy 只会迭代返回值，因此无需构造列表
+            return chain((".", ".."), children)
         except BaseException as e:
-            raise
+            self.cache.pop(path, None)
             self._log(
                 logging.ERROR, 
                 "can't readdir: \x1b[4;34m%s\x1b[0m\n  |_ \x1b[1;4;31m%s\x1b[0m: %s", 
@@ -311,12 +510,15 @@ ON CONFLICT DO UPDATE SET data = excluded.data;""", locals())
         self._log(logging.DEBUG, "release(path=\x1b[4;34m%r\x1b[0m, fh=%r)", path, fh)
         if not fh:
             return
+        slots = self._fh_slots
+        with self._fh_lock:
+            item = slots[fh]
+            slots[fh] = None
+            self._fh_free.append(fh)
+        if item is None:
+            return
         try:
-            file, _ = self._fh_to_file.pop(fh)
-            if file is not None:
-                file.close()
-        except KeyError:
-            pass
+            self._close_file(item)
         except BaseException as e:
             self._log(
                 logging.ERROR, 
@@ -94,18 +94,12 @@ def main(argv: None | list[str] | Namespace = None, /):
     if args.port:
         run_config["port"] = args.port
     elif not run_config.get("port"):
-        from socket import create_connection
-
-        def get_available_ip(start: int = 1024, stop: int = 65536) -> int:
-            for port in range(start, stop):
-                try:
-                    with create_connection(("127.0.0.1", port), timeout=1):
-                        pass
-                except OSError:
-                    return port
-            raise RuntimeError("no available ports")
-
-        run_config["port"] = get_available_ip()
+        from socket import socket
+
+        # NOTE: 绑定到 0 号端口，由系统分配一个空闲端口
+        with socket() as sock:
+            sock.bind(("", 0))
+            run_config["port"] = sock.getsockname()[1]
 
     run_config.setdefault("proxy_headers", True)
     run_config.setdefault("server_header", False)
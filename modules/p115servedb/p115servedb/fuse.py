@@ -125,6 +125,9 @@ def main(argv: None | list[str] | Namespace = None, /):
         predicate=predicate, 
         strm_predicate=strm_predicate, 
         strm_origin=args.strm_origin, 
+        cache_size=args.cache_size, 
+        file_cache_size=args.file_cache_size, 
+        cache_policy=args.cache_policy, 
     ).run(**options)
 
 
@@ -132,6 +135,12 @@ parser.add_argument("mount_point", nargs="?", help="挂载路径")
 parser.add_argument("-f", "--dbfile", required=True, help="数据库文件路径")
 parser.add_argument("-cp", "--cookies-path", default="", help="cookies cookies 文件保存路径，默认为当前工作目录下的 115-cookies.txt（如果 115-cookies.txt 不存在，则使用 -o/--strm-origin 所指定的服务进行下载）")
 parser.add_argument("-o", "--strm-origin", default="http://localhost:8000", help="strm 所用的 302 服务地址，默认为 'http://localhost:8000'")
+parser.add_argument("-cs", "--cache-size", default=16384, type=int, help="缓存的目录列表的最大数量，默认值: 16384")
+parser.add_argument("-cpo", "--cache-policy", default="lru", choices=("lru", "mru"), help="""目录列表缓存的淘汰策略，默认值为 'lru'
+    - lru          （默认值）淘汰最久未使用的
+    - mru          淘汰最近使用的，适合经常扫描整个目录树（例如媒体库索引）的场景
+""")
+parser.add_argument("-fcs", "--file-cache-size", default=0, type=int, help="小文件缓存的最大总字节数，超出时淘汰最久未使用的，默认值: 0，即不限制")
 parser.add_argument("-p1", "--predicate", help="断言，当断言的结果为 True 时，文件或目录会被显示")
 parser.add_argument(
     "-t1", "--predicate-type", default="ignore", 
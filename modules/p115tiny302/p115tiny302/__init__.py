@@ -7,17 +7,19 @@ __license__ = "GPLv3 <https://www.gnu.org/licenses/gpl-3.0.txt>"
 
 import logging
 
+from asyncio import create_task, shield, Task
 from collections.abc import Buffer, Mapping
 from errno import ENOENT
 from hashlib import sha1 as calc_sha1
+from hmac import compare_digest
 from http import HTTPStatus
 from re import compile as re_compile
-from string import digits, hexdigits
+from string import digits
 from time import time
 from typing import Final
 from urllib.parse import parse_qsl, quote, unquote, urlsplit, urlunsplit
 
-from blacksheep import json, text, Application, Request, Response, Router
+from blacksheep import text, Application, Request, Response, Router
 from blacksheep.contents import Content
 from blacksheep.server.remotes.forwarding import ForwardedHeadersMiddleware
 from cachedict import LRUDict, TLRUDict
@@ -31,6 +33,7 @@ from rich.text import Text
 from uvicorn.config import LOGGING_CONFIG
 
 
+CRE_sha1_fullmatch: Final = re_compile("[0-9a-fA-F]{40}").fullmatch
 CRE_name_search: Final = re_compile("[^&=]+(?=&|$)").match
 
 LOGGING_CONFIG["formatters"]["default"]["fmt"] = "[\x1b[1m%(asctime)s\x1b[0m] %(levelprefix)s %(message)s"
@@ -83,6 +86,10 @@ def get_first(m: Mapping, *keys, default=None):
     return default
 
 
+def json_response(obj, /, status: int = 200) -> Response:
+    return Response(status, None, Content(b"application/json", dumps(obj)))
+
+
 def make_application(
     client: P115Client, 
     debug: bool = False, 
@@ -99,6 +106,22 @@ def make_application(
     DOWNLOAD_URL_CACHE1: TLRUDict[str | tuple[str, int], P115URL] = TLRUDict(cache_size)
     DOWNLOAD_URL_CACHE2: TLRUDict[tuple[str, str], P115URL] = TLRUDict(1024)
     RECEIVE_CODE_MAP: dict[str, str] = {}
+    DOWNLOAD_URL_INFLIGHT: dict[tuple[str, str, str], Task[P115URL]] = {}
+
+    # NOTE: 未设置 token 时，check_sign 为 None，请求时直接跳过签名检查
+    if token:
+        sign_hasher = calc_sha1(bytes(f"302@115-{token}-", "utf-8"))
+
+        def check_sign(value, sign: str, t: int, /) -> None | Response:
+            hasher = sign_hasher.copy()
+            hasher.update(bytes(f"{t}-{value}", "utf-8"))
+            if not (sign.isascii() and compare_digest(sign, hasher.hexdigest())):
+                return json_response({"state": False, "message": "invalid sign"}, 403)
+            elif t > 0 and t <= time():
+                return json_response({"state": False, "message": "url was expired"}, 401)
+            return None
+    else:
+        check_sign = None
 
     app = Application(router=Router(), show_error_details=debug)
     logger = getattr(app, "logger")
@@ -253,11 +276,37 @@ def make_application(
         user_agent: str = "", 
         app: str = "android", 
     ) -> P115URL:
+        key = (pickcode, user_agent, app)
         if (cache_url and (r := DOWNLOAD_URL_CACHE.get((pickcode, user_agent)))
             or (r := DOWNLOAD_URL_CACHE1.get(pickcode))
             or (r := DOWNLOAD_URL_CACHE2.get((pickcode, user_agent)))
         ):
-            return r[1]
+            expire_ts, url = r
+            # NOTE: 链接即将过期时，先返回缓存，并在后台提前刷新
+            if expire_ts - time() < 60 and key not in DOWNLOAD_URL_INFLIGHT:
+                start_request_downurl(key)
+            return url
+        # NOTE: 合并并发的相同请求，只向 115 发出 1 次
+        if not (task := DOWNLOAD_URL_INFLIGHT.get(key)):
+            task = start_request_downurl(key)
+        return await shield(task)
+
+    def start_request_downurl(key: tuple[str, str, str], /) -> Task[P115URL]:
+        pickcode, user_agent, app = key
+        task = DOWNLOAD_URL_INFLIGHT[key] = create_task(request_downurl(pickcode, user_agent, app=app))
+        def done(task, /):
+            DOWNLOAD_URL_INFLIGHT.pop(key, None)
+            # NOTE: 后台刷新的任务无人等待，失败时记录日志，以免异常被静默吞掉
+            if not task.cancelled() and (exc := task.exception()) is not None:
+                logger.warning(f"failed to request download url for {key!r}: {type(exc).__qualname__}: {exc}", exc_info=exc)
+        task.add_done_callback(done)
+        return task
+
+    async def request_downurl(
+        pickcode: str, 
+        user_agent: str = "", 
+        app: str = "android", 
+    ) -> P115URL:
         url = await client.download_url(pickcode, headers={"User-Agent": user_agent}, app=app or "android", async_=True)
         expire_ts = int(next(v for k, v in parse_qsl(urlsplit(url).query) if k == "t")) - 60 * 5
         if "&c=0&f=&" in url:
@@ -313,16 +362,9 @@ def make_application(
         sign: str = "", 
         t: int = 0, 
     ):
-        def check_sign(value, /):
-            if not token:
-                return None
-            if sign != calc_sha1(bytes(f"302@115-{token}-{t}-{value}", "utf-8")).hexdigest():
-                return json({"state": False, "message": "invalid sign"}, 403)
-            elif t > 0 and t <= time():
-                return json({"state": False, "message": "url was expired"}, 401)
         file_name = name or name2
         if share_code:
-            if resp := check_sign(id if id else file_name):
+            if check_sign and (resp := check_sign(id if id else file_name, sign, t)):
                 return resp
             if not receive_code:
                 receive_code = await get_receive_code(share_code)
@@ -336,18 +378,18 @@ def make_application(
             url = await get_share_downurl(share_code, receive_code, id, app=app)
         else:
             if pickcode:
-                if resp := check_sign(pickcode):
+                if check_sign and (resp := check_sign(pickcode, sign, t)):
                     return resp
                 if not (len(pickcode) == 17 and pickcode.isalnum()):
                     raise ValueError(f"bad pickcode: {pickcode!r}")
             elif id:
-                if resp := check_sign(id):
+                if check_sign and (resp := check_sign(id, sign, t)):
                     return resp
                 pickcode = await get_pickcode_to_id(id)
             elif sha1:
-                if resp := check_sign(sha1):
+                if check_sign and (resp := check_sign(sha1, sign, t)):
                     return resp
-                if len(sha1) != 40 or sha1.strip(hexdigits):
+                if not CRE_sha1_fullmatch(sha1):
                     raise ValueError(f"bad sha1: {sha1!r}")
                 pickcode = await get_pickcode_for_sha1(sha1.upper())
             else:
@@ -357,13 +399,13 @@ def make_application(
                 elif not name and (idx := file_name.find("/")) > 0:
                     file_name, remains = file_name[:idx], file_name[idx:]
                 if file_name:
-                    if resp := check_sign(file_name + remains):
+                    if check_sign and (resp := check_sign(file_name + remains, sign, t)):
                         return resp
                     if len(file_name) == 17 and file_name.isalnum():
                         pickcode = file_name.lower()
                     elif not file_name.strip(digits):
                         pickcode = await get_pickcode_to_id(int(file_name))
-                    elif len(file_name) == 40 and not file_name.strip(hexdigits):
+                    elif CRE_sha1_fullmatch(file_name):
                         pickcode = await get_pickcode_for_sha1(file_name.upper())
                     else:
                         pickcode = await get_pickcode_for_name(file_name + remains, refresh=refresh)
@@ -26,6 +26,7 @@ parser.add_argument("-sst", "--auto-splitting-statistics-timeout", type=float, d
 parser.add_argument("-nm", "--no-dir-moved", action="store_true", help="声明没有目录被移动或改名（但可以有目录被新增或删除），这可以加快批量拉取时的速度")
 parser.add_argument("-r", "--refresh", action="store_true", help="是否强制刷新")
 parser.add_argument("-nr", "--not-recursive", action="store_true", help="不遍历目录树：只拉取顶层目录，不递归子目录")
+parser.add_argument("-m", "--max-workers", type=int, default=1, help="并发拉取目录树的最大线程数，仅对不需要拆分的目录树生效，如果 <= 1，则不并发，默认值: 1")
 parser.add_argument("-de", "--disable-event", action="store_true", help="关闭 event 表的数据收集")
 parser.add_argument("-cl", "--check-for-relogin", action="store_true", help="当风控时，自动重新扫码登录")
 parser.add_argument("-v", "--version", action="store_true", help="输出版本号")
@@ -70,6 +71,7 @@ def main(argv: None | list[str] | Namespace = None, /):
         recursive=not args.not_recursive, 
         interval=args.interval, 
         disable_event=args.disable_event, 
+        max_workers=args.max_workers, 
     )
 
 
@@ -3,7 +3,7 @@
 
 __author__ = "ChenyangGao <https://chenyanggao.github.io>"
 __all__ = [
-    "get_dir_count", "has_id", "iter_existing_id", "get_parent_id", "iter_parent_id", 
+    "tune", "register_functions", "get_dir_count", "has_id", "iter_existing_id", "get_parent_id", "iter_parent_id", 
     "iter_id_to_parent_id", "iter_id_to_path", "id_to_path", "get_id", "get_pickcode", 
     "get_sha1", "get_path", "get_ancestors", "get_attr", "iter_children", 
     "iter_descendants", "iter_descendants_bfs", "iter_files_with_path_url", 
@@ -15,16 +15,15 @@ from collections.abc import Callable, Iterable, Iterator, Sequence
 from csv import writer
 from datetime import datetime
 from errno import ENOENT, ENOTDIR
-from itertools import batched
+from itertools import batched, chain
 from ntpath import normpath
 from os.path import expanduser
 from pathlib import Path
-from sqlite3 import register_converter, Connection, Cursor, OperationalError
+from sqlite3 import register_converter, Connection, Cursor, OperationalError, SQLITE_LIMIT_VARIABLE_NUMBER
 from posixpath import join
 from typing import cast, overload, Any, Final, Literal
 from urllib.parse import quote
 
-from iterutils import bfs_gen, group_collect
 from orjson import dumps, loads
 from posixpatht import escape, path_is_dir_form, splits
 from sqlitetools import find, query, transact
@@ -35,11 +34,110 @@ FIELDS: Final = (
     "ctime", "mtime", "is_collect", "is_alive", "updated_at", 
 )
 EXTENDED_FIELDS: Final = (*FIELDS, "depth", "path", "posixpath", "ancestors")
+# NOTE: 缓存动态生成的行工厂函数的构造器，键是 (字段元组, 是否产生字典, 需要解析的字段元组)
+_ROW_FACTORY_MAKERS: Final[dict[tuple, Callable]] = {}
+# NOTE: 按 id 的单点查询的 SQL，会被频繁调用，所以预先拼好，用 bool(is_alive) 作为下标选取
+_SQL_HAS_ID: Final = (
+    "SELECT 1 FROM data WHERE id=?", 
+    "SELECT 1 FROM data WHERE id=? AND is_alive", 
+)
+_SQL_GET_PICKCODE: Final = (
+    "SELECT pickcode FROM data WHERE id=? LIMIT 1", 
+    "SELECT pickcode FROM data WHERE id=? AND is_alive LIMIT 1", 
+)
+_SQL_GET_SHA1: Final = (
+    "SELECT sha1 FROM data WHERE id=? LIMIT 1", 
+    "SELECT sha1 FROM data WHERE id=? AND is_alive LIMIT 1", 
+)
+_SQL_GET_PARENT_ID: Final = "SELECT parent_id FROM data WHERE id=?"
+_SQL_GET_ATTR: Final = f"SELECT {','.join(FIELDS)} FROM data WHERE id=? LIMIT 1"
 
 register_converter("DATETIME", lambda dt: datetime.fromisoformat(str(dt, "utf-8")))
 register_converter("JSON", loads)
 
 
+def _dumps_ids(ids: Iterable[int], /) -> str:
+    """把一组 id 序列化为 JSON 数组，以便作为单个参数绑定，在 SQL 中用 `json_each(?)` 展开
+
+    :param ids: 一组 id
+
+    :return: JSON 字符串
+    """
+    if not isinstance(ids, (list, tuple)):
+        ids = list(ids)
+    return dumps(ids).decode("ascii")
+
+
+def _make_row_factory(
+    fields: tuple[str, ...], 
+    /, 
+    to_dict: bool = True, 
+    parsers: dict[str, Callable] = {}, 
+) -> Callable:
+    """生成行工厂函数，把每一行直接用字典（或元组）字面量构造出来，而不是 `dict(zip(...))` 或逐个字段判断
+
+    :param fields: 字段元组（必须都是合法的标识符）
+    :param to_dict: 是否产生字典，否则产生元组
+    :param parsers: 字段名到解析函数的映射，这些字段的值会先经过解析
+
+    :return: 行工厂函数，可用作 `row_factory`
+    """
+    key = (fields, to_dict, tuple(parsers))
+    try:
+        make = _ROW_FACTORY_MAKERS[key]
+    except KeyError:
+        values = [f"parse_{f}(r[{i}])" if f in parsers else f"r[{i}]" for i, f in enumerate(fields)]
+        if to_dict:
+            expr = "{%s}" % ", ".join(f"{f!r}: {v}" for f, v in zip(fields, values))
+        else:
+            expr = "(%s,)" % ", ".join(values)
+        ns: dict = {}
+        exec(f"""\
+def make({", ".join(f"parse_{f}" for f in parsers)}):
+    def row_factory(_, r):
+        return {expr}
+    return row_factory""", ns)
+        make = _ROW_FACTORY_MAKERS[key] = ns["make"]
+    return make(*parsers.values())
+
+
+def tune(con: Connection | Cursor, /):
+    """调整连接的 PRAGMA，以加速大批量的读取（递归查询、全表扫描等）
+
+    .. note::
+        本模块的查询函数不会自动调用此函数，是否调整由调用方决定，调整会在此连接上一直生效。
+        只调整对读取有影响、且只作用于当前连接的设置：页缓存 64 MB、内存映射 1 GB、临时表和索引保存在内存中。
+        如果页缓存已经是 64 MB（例如已经调用过此函数，或者由 `initdb` 初始化），则直接返回
+
+    :param con: 数据库连接或游标
+    """
+    if isinstance(con, Cursor):
+        con = con.connection
+    if con.execute("PRAGMA cache_size").fetchone()[0] == -65536:
+        return
+    # NOTE: 不用 executescript，因为它会先提交当前的事务
+    con.execute("PRAGMA cache_size = -65536")
+    con.execute("PRAGMA mmap_size = 1073741824")
+    con.execute("PRAGMA temp_store = MEMORY")
+
+
+def register_functions(con: Connection | Cursor, /):
+    """在连接上注册本模块的 SQL 会用到的自定义函数
+
+    .. note::
+        目前只有 `escape_name(name)`，即 `posixpatht.escape`，用于在 SQL 中拼接路径。
+        如果已经注册过，则直接返回（连接上还有未完成的语句时，重复注册会失败）
+
+    :param con: 数据库连接或游标
+    """
+    if isinstance(con, Cursor):
+        con = con.connection
+    try:
+        con.execute("SELECT escape_name('')").fetchone()
+    except OperationalError:
+        con.create_function("escape_name", 1, escape, deterministic=True)
+
+
 def get_dir_count(
     con: Connection | Cursor, 
     id: int = 0, 
@@ -64,10 +162,8 @@ def has_id(
         return 1
     elif id < 0:
         return 0
-    sql = "SELECT 1 FROM data WHERE id=?"
-    if is_alive:
-        sql += " AND is_alive"
-    return find(con, sql, id, 0)
+    # NOTE: 单点查询直接在连接上执行，不经过 find 的包装
+    return 1 if con.execute(_SQL_HAS_ID[bool(is_alive)], (id,)).fetchone() else 0
 
 
 def iter_existing_id(
@@ -76,10 +172,11 @@ def iter_existing_id(
     /, 
     is_alive: bool = True, 
 ) -> Iterator[int]:
-    sql = "SELECT id FROM data WHERE id IN (%s)" % (",".join(map("%d".__mod__, ids)) or "NULL")
+    # NOTE: 所有 id 作为一个 JSON 参数绑定，语句文本固定，可以被语句缓存复用，也不受参数个数上限的影响
+    sql = "SELECT id FROM data WHERE id IN (SELECT value FROM json_each(?))"
     if is_alive:
         sql += " AND is_alive"
-    return query(con, sql, row_factory="one")
+    return query(con, sql, (_dumps_ids(ids),), row_factory="one")
 
 
 def get_parent_id(
@@ -90,8 +187,12 @@ def get_parent_id(
 ) -> int:
     if id == 0:
         return 0
-    sql = "SELECT parent_id FROM data WHERE id=?"
-    return find(con, sql, id, FileNotFoundError(ENOENT, id) if default is None else default)
+    row = con.execute(_SQL_GET_PARENT_ID, (id,)).fetchone()
+    if row is not None:
+        return row[0]
+    elif default is None:
+        raise FileNotFoundError(ENOENT, id)
+    return default
 
 
 def iter_parent_id(
@@ -99,8 +200,8 @@ def iter_parent_id(
     ids: Iterable[int], 
     /, 
 ) -> Iterator[int]:
-    sql = "SELECT parent_id FROM data WHERE id IN (%s)" % (",".join(map("%d".__mod__, ids)) or "NULL")
-    return query(con, sql, row_factory="one")
+    sql = "SELECT parent_id FROM data WHERE id IN (SELECT value FROM json_each(?))"
+    return query(con, sql, (_dumps_ids(ids),), row_factory="one")
 
 
 def iter_id_to_parent_id(
@@ -109,17 +210,16 @@ def iter_id_to_parent_id(
     /, 
     recursive: bool = False, 
 ) -> Iterator[tuple[int, int]]:
-    s_ids = "(%s)" % (",".join(map(str, ids)) or "NULL")
     if recursive:
         sql = """\
 WITH pairs AS (
-    SELECT id, parent_id FROM data WHERE id IN %s
+    SELECT id, parent_id FROM data WHERE id IN (SELECT value FROM json_each(?))
     UNION ALL
     SELECT data.id, data.parent_id FROM pairs JOIN data ON (pairs.parent_id = data.id)
-) SELECT * FROM pairs""" % s_ids
+) SELECT * FROM pairs"""
     else:
-        sql = "SELECT id, parent_id FROM data WHERE id IN %s" % s_ids
-    return query(con, sql)
+        sql = "SELECT id, parent_id FROM data WHERE id IN (SELECT value FROM json_each(?))"
+    return query(con, sql, (_dumps_ids(ids),))
 
 
 def iter_id_to_path(
@@ -155,20 +255,30 @@ def iter_id_to_path(
         patht = ("", *filter(None, path))
     if not parent_id and len(patht) == 1:
         return iter((0,))
-    if len(patht) > 2:
-        sql = "SELECT id FROM data WHERE parent_id=? AND name=? AND is_alive AND is_dir LIMIT 1"
-        for name in patht[1:-1]:
-            parent_id = find(con, sql, (parent_id, name), default=-1)
-            if parent_id < 0:
-                return iter(())
-    sql = "SELECT id FROM data WHERE parent_id=? AND name=? AND is_alive"
+    where = ""
     if ensure_file is None:
-        sql += " ORDER BY is_dir DESC"
+        where = " ORDER BY is_dir DESC"
     elif ensure_file:
-        sql += " AND NOT is_dir"
+        where = " AND NOT is_dir"
     else:
-        sql += " AND is_dir LIMIT 1"
-    return query(con, sql, (parent_id, patht[-1]), row_factory="one")
+        where = " AND is_dir LIMIT 1"
+    if len(patht) > 2:
+        # NOTE: 中间的各级目录由一条递归 CTE 逐级查找，整个路径只需执行一次查询。找不到时 id 为 NULL，递归随之终止
+        sql = f"""\
+WITH names(i, name) AS (
+    SELECT key, value FROM json_each(?)
+), t(i, id) AS (
+    SELECT 0, ?
+    UNION ALL
+    SELECT t.i + 1, (SELECT id FROM data WHERE parent_id=t.id AND name=names.name AND is_alive AND is_dir LIMIT 1) 
+    FROM t JOIN names ON (names.i = t.i) WHERE t.id IS NOT NULL
+)
+SELECT id FROM data WHERE parent_id=(SELECT id FROM t ORDER BY i DESC LIMIT 1) AND name=? AND is_alive{where}"""
+        params: tuple = (dumps(patht[1:-1]).decode("utf-8"), parent_id, patht[-1])
+    else:
+        sql = "SELECT id FROM data WHERE parent_id=? AND name=? AND is_alive" + where
+        params = (parent_id, patht[-1])
+    return query(con, sql, params, row_factory="one")
 
 
 def id_to_path(
@@ -256,12 +366,10 @@ def get_pickcode(
     if id >= 0:
         if not id:
             return ""
-        return find(
-            con, 
-            f"SELECT pickcode FROM data WHERE id=?{insertion} LIMIT 1;", 
-            id, 
-            default=FileNotFoundError(id), 
-        )
+        row = con.execute(_SQL_GET_PICKCODE[bool(is_alive)], (id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(id)
+        return row[0]
     elif sha1:
         return find(
             con, 
@@ -296,12 +404,10 @@ def get_sha1(
     if id >= 0:
         if not id:
             return ""
-        return find(
-            con, 
-            f"SELECT sha1 FROM data WHERE id=?{insertion} LIMIT 1;", 
-            id, 
-            default=FileNotFoundError(id), 
-        )
+        row = con.execute(_SQL_GET_SHA1[bool(is_alive)], (id,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(id)
+        return row[0]
     elif pickcode:
         return find(
             con, 
@@ -354,12 +460,12 @@ WITH t AS (
     UNION ALL
     SELECT data.id, data.parent_id, data.name FROM t JOIN data ON (t.parent_id = data.id)
 )
-SELECT id, parent_id, name FROM t;""", id))
+SELECT id, parent_id, name FROM t;""", id, row_factory=lambda _, r: {"id": r[0], "parent_id": r[1], "name": r[2]}))
     if not ls:
         raise FileNotFoundError(ENOENT, id)
-    if ls[-1][1]:
+    if ls[-1]["parent_id"]:
         raise ValueError(f"dangling id: {id}")
-    ancestors.extend(dict(zip(("id", "parent_id", "name"), record)) for record in reversed(ls))
+    ancestors.extend(reversed(ls))
     return ancestors
 
 
@@ -381,13 +487,10 @@ def get_attr(
             "is_dir": 1, "type": 0, "ctime": 0, "mtime": 0, "is_collect": 0, 
             "is_alive": 1, "updated_at": datetime.fromtimestamp(0), 
         }
-    return find(
-        con, 
-        f"SELECT {','.join(FIELDS)} FROM data WHERE id=? LIMIT 1", 
-        id, 
-        FileNotFoundError(ENOENT, id), 
-        row_factory="dict", 
-    )
+    row = con.execute(_SQL_GET_ATTR, (id,)).fetchone()
+    if row is None:
+        raise FileNotFoundError(ENOENT, id)
+    return dict(zip(FIELDS, row))
 
 
 def iter_children(
@@ -469,13 +572,13 @@ def iter_descendants(
         if 0 <= max_depth < min_depth:
             return
         depth = 1
+        attr = get_attr(con, parent_id)
         if with_path:
             if not parent_id:
                 ancestors: list[dict] = [{"id": 0, "parent_id": 0, "name": ""}]
                 dir_ = posixdir = "/"
             elif use_relpath:
                 if with_root:
-                    attr = parent_id = get_attr(con, parent_id)
                     name = attr["name"]
                     ancestors = [{"id": attr["id"], "parent_id": attr["parent_id"], "name": name}]
                     dir_ = escape(name) + "/"
@@ -497,82 +600,82 @@ def iter_descendants(
             if dir_ != "/":
                 dir_ += "/"
                 posixdir += "/"
-    if topdown is None:
-        if with_path:
-            gen = bfs_gen((parent_id, 0, ancestors, dir_, posixdir))
-        else:
-            gen = bfs_gen((parent_id, 0)) # type: ignore
-        send: Callable = gen.send
-        p: list
-        for parent_id, depth, *p in gen:
-            depth += 1
-            will_step_in = max_depth < 0 or depth < max_depth
-            will_yield = min_depth <= depth and (max_depth < 0 or depth <= max_depth)
-            if with_path:
-                ancestors, dir_, posixdir = p
-            for attr in iter_children(con, parent_id, False if ensure_file is False else None):
-                attr["depth"] = depth
-                is_dir = attr["is_dir"]
-                if with_path:
-                    attr["ancestors"] = [
-                        *ancestors, 
-                        {k: attr[k] for k in ("id", "parent_id", "name")}, 
-                    ]
-                    attr["path"] = dir_ + escape(attr["name"])
-                    attr["posixpath"] = posixdir + attr["name"].replace("/", "|")
-                if is_dir and will_step_in:
-                    if with_path:
-                        send((attr, depth, attr["ancestors"], attr["path"] + "/", attr["posixpath"] + "/"))
-                    else:
-                        send((attr, depth))
-                if will_yield:
-                    if ensure_file is None:
-                        yield attr
-                    elif is_dir:
-                        if not ensure_file:
-                            yield attr
-                    elif ensure_file:
-                        yield attr
+    if not attr["is_dir"]:
+        raise NotADirectoryError(ENOTDIR, attr)
+    if 0 <= max_depth < depth:
+        return
+    # NOTE: 用一条递归 CTE 完成整个遍历，而不是每个目录执行一次查询。队列按 depth 逆序出队时为深度优先（先序），默认的先进先出则为宽度优先
+    where1, where2 = "", ""
+    if ensure_file is False:
+        where1 = " AND is_dir"
+        where2 = " AND data.is_dir"
+    if max_depth >= 0:
+        where2 += f" AND t.depth < {max_depth:d}"
+    if topdown is not None:
+        where2 += f"\n    ORDER BY {len(FIELDS) + 1} DESC"
+    if with_path:
+        # NOTE: 路径也在递归中逐级拼接，由 SQLite 完成字符串操作，Python 只需维护 ancestors
+        register_functions(con)
+        sql = f"""\
+WITH t({",".join(FIELDS)}, depth, path, posixpath) AS (
+    SELECT {",".join(FIELDS)}, {depth:d}, :dir || escape_name(name), :posixdir || replace(name, '/', '|') FROM data WHERE parent_id=:id AND is_alive{where1}
+    UNION ALL
+    SELECT {",".join("data." + f for f in FIELDS)}, t.depth + 1, t.path || '/' || escape_name(data.name), t.posixpath || '/' || replace(data.name, '/', '|') FROM t JOIN data ON (t.id = data.parent_id) WHERE t.is_dir AND data.is_alive{where2}
+) SELECT * FROM t"""
+        params: Any = {"id": attr["id"], "dir": dir_, "posixdir": posixdir}
     else:
-        will_step_in = max_depth < 0 or depth < max_depth
-        will_yield = min_depth <= depth and (max_depth < 0 or depth <= max_depth)
-        for attr in iter_children(con, parent_id, False if ensure_file is False else None):
-            is_dir = attr["is_dir"]
-            attr["depth"] = depth
-            if with_path:
-                attr["ancestors"] = [
-                    *ancestors, 
-                    {k: attr[k] for k in ("id", "parent_id", "name")}, 
-                ]
-                attr["path"] = dir_ + escape(attr["name"])
-                attr["posixpath"] = posixdir + attr["name"].replace("/", "|")
-            if will_yield and topdown:
-                if ensure_file is None:
-                    yield attr
-                elif is_dir:
-                    if not ensure_file:
-                        yield attr
-                elif ensure_file:
-                    yield attr
-            if is_dir and will_step_in:
-                yield from iter_descendants(
-                    con, 
-                    attr, 
-                    min_depth=min_depth, 
-                    max_depth=max_depth, 
-                    ensure_file=ensure_file, 
-                    use_relpath=use_relpath, 
-                    with_root=with_root, 
-                    topdown=topdown, 
-                )
-            if will_yield and not topdown:
-                if ensure_file is None:
-                    yield attr
-                elif is_dir:
-                    if not ensure_file:
-                        yield attr
-                elif ensure_file:
-                    yield attr
+        sql = f"""\
+WITH t({",".join(FIELDS)}, depth) AS (
+    SELECT {",".join(FIELDS)}, {depth:d} FROM data WHERE parent_id=? AND is_alive{where1}
+    UNION ALL
+    SELECT {",".join("data." + f for f in FIELDS)}, t.depth + 1 FROM t JOIN data ON (t.id = data.parent_id) WHERE t.is_dir AND data.is_alive{where2}
+) SELECT * FROM t"""
+        params = attr["id"]
+        # NOTE: 不需要拼接路径时，目录的行只用来向下递归，所以可以在 SQL 中就把不会输出的行过滤掉，不必再构造字典
+        if ensure_file:
+            sql += " WHERE NOT is_dir"
+            if min_depth > depth:
+                sql += f" AND depth >= {min_depth:d}"
+        elif min_depth > depth:
+            sql += f" WHERE depth >= {min_depth:d}"
+    if with_path:
+        # NOTE: 目录 id 到它的祖先列表的映射，子节点据此构造自己的 ancestors
+        id_to_ancestors: dict[int, list[dict]] = {attr["id"]: ancestors}
+    def select(attr: dict, /) -> bool:
+        if attr["depth"] < min_depth:
+            return False
+        if ensure_file is None:
+            return True
+        elif attr["is_dir"]:
+            return not ensure_file
+        return ensure_file
+    stack: list[dict] = []
+    push = stack.append
+    pop = stack.pop
+    for attr in query(con, sql, params, row_factory="dict"):
+        is_dir = attr["is_dir"]
+        if with_path:
+            attr["ancestors"] = [
+                *id_to_ancestors[attr["parent_id"]], 
+                {"id": attr["id"], "parent_id": attr["parent_id"], "name": attr["name"]}, 
+            ]
+            if is_dir:
+                id_to_ancestors[attr["id"]] = attr["ancestors"]
+        if topdown is False:
+            # NOTE: 先序流中，一个目录之后出现了深度不大于它的节点，说明它的子树已经遍历完毕
+            depth = attr["depth"]
+            while stack and stack[-1]["depth"] >= depth:
+                if select(attr_ := pop()):
+                    yield attr_
+            if is_dir:
+                push(attr)
+            elif select(attr):
+                yield attr
+        elif select(attr):
+            yield attr
+    while stack:
+        if select(attr_ := pop()):
+            yield attr_
 
 
 @overload
@@ -771,32 +874,18 @@ WITH t AS (
             row_factory = lambda _, r: r[0]
         else:
             row_factory = lambda _, r: parse(r[0])
-    elif to_dict:
-        def row_factory(_, r):
-            d = dict(zip(fields, r))
-            if with_ancestors:
-                d["ancestors"] = parse_ancestors(d["ancestors"])
-            if with_path:
-                d["path"] = parse_path(d["path"])
-            if with_posixpath:
-                d["posixpath"] = parse_posixpath(d["posixpath"])
-            return d
     else:
-        with_route = with_ancestors or with_path or with_posixpath
-        def parse(f, v):
-            match f:
-                case "ancestors":
-                    return parse_ancestors(v)
-                case "path":
-                    return parse_path(v)
-                case "posixpath":
-                    return parse_posixpath(v)
-                case _:
-                    return v
-        def row_factory(_, r):
-            if with_route:
-                return tuple(parse(f, v) for f, v in zip(fields, r))
-            return r
+        parsers: dict[str, Callable] = {}
+        if with_ancestors:
+            parsers["ancestors"] = parse_ancestors
+        if with_path:
+            parsers["path"] = parse_path
+        if with_posixpath:
+            parsers["posixpath"] = parse_posixpath
+        if to_dict or parsers:
+            row_factory = _make_row_factory(fields, to_dict=to_dict, parsers=parsers)
+        else:
+            row_factory = lambda _, r: r
     return query(con, sql, row_factory=row_factory)
 
 
@@ -816,14 +905,19 @@ def iter_files_with_path_url(
     """
     if isinstance(parent_id, str):
         parent_id = get_id(con, path=parent_id)
-    code = compile('f"%s/{quote(name, '"''"')}?{id=}&{pickcode=!s}&{sha1=!s}&{size=}&file=true"' % base_url.translate({ord(c): c*2 for c in "{}"}), "-", "eval")
+    # NOTE: 预先生成格式模板，每个文件只需调用一次 str.format_map，而不必执行 eval
+    format_url = (
+        base_url.translate({ord(c): c*2 for c in "{}"}) + 
+        "/{name}?id={id}&pickcode={pickcode}&sha1={sha1}&size={size}&file=true"
+    ).format_map
     for attr in iter_descendants_bfs(
         con, 
         parent_id, 
         fields=("id", "sha1", "pickcode", "size", "name", "posixpath"), 
         ensure_file=True, 
     ):
-        yield attr["posixpath"], eval(code, None, attr)
+        attr["name"] = quote(attr["name"], "")
+        yield attr["posixpath"], format_url(attr)
 
 
 def iter_dup_files(
@@ -836,17 +930,20 @@ def iter_dup_files(
 
     :return: 迭代器，一组文件的信息
     """
+    # NOTE: 先在 (sha1, size) 的部分索引上分组，找出有重复的组，再只对这些组里的文件执行窗口函数
     sql = f"""\
-WITH stats AS (
+WITH dups(sha1, size) AS (
+    SELECT sha1, size FROM data WHERE NOT is_dir AND is_alive GROUP BY sha1, size HAVING COUNT(1) > 1
+), stats AS (
     SELECT
         COUNT(1) OVER w AS total, 
         ROW_NUMBER() OVER w AS nth, 
-        {",".join(FIELDS)}
-    FROM data
-    WHERE NOT is_dir AND is_alive
-    WINDOW w AS (PARTITION BY sha1, size)
+        {",".join("data." + f for f in FIELDS)}
+    FROM dups JOIN data USING (sha1, size)
+    WHERE NOT data.is_dir AND data.is_alive
+    WINDOW w AS (PARTITION BY data.sha1, data.size)
 )
-SELECT * FROM stats WHERE total > 1"""
+SELECT * FROM stats"""
     return query(con, sql, row_factory="dict")
 
 
@@ -911,32 +1008,16 @@ def select_na_ids(
 
     :return: 一组悬空节点的 id 的集合
     """
-    ok_ids: set[int] = set(query(con, "SELECT id FROM data WHERE NOT is_alive", row_factory="one"))
-    na_ids: set[int] = set()
-    d = dict(query(con, "SELECT id, parent_id FROM data WHERE is_alive"))
-    temp: list[int] = []
-    push = temp.append
-    clear = temp.clear
-    update_ok = ok_ids.update
-    update_na = na_ids.update
-    for k, v in d.items():
-        try:
-            push(k)
-            while k := d[k]:
-                if k in ok_ids:
-                    update_ok(temp)
-                    break
-                elif k in na_ids:
-                    update_na(temp)
-                    break
-                push(k)
-            else:
-                update_ok(temp)
-        except KeyError:
-            update_na(temp)
-        finally:
-            clear()
-    return na_ids
+    # NOTE: 从悬空的 parent_id 出发，沿着存活的子节点向下扩展，遍历由 SQLite 完成；UNION 去重，也避免了环路导致的死循环
+    sql = """\
+WITH na_ids(id) AS (
+    SELECT parent_id FROM data WHERE is_alive AND parent_id AND NOT EXISTS (SELECT 1 FROM data AS p WHERE p.id = data.parent_id)
+    UNION
+    SELECT data.id FROM na_ids JOIN data ON (data.parent_id = na_ids.id) WHERE data.is_alive
+)
+SELECT id FROM na_ids"""
+    # NOTE: 结果只有一列，直接解包游标上的元组构建集合，不必逐行经过 row_factory
+    return {id for id, in con.execute(sql)}
 
 
 def select_mtime_groups(
@@ -953,12 +1034,18 @@ def select_mtime_groups(
 
     :return: 元组的列表（逆序排列），每个元组第 1 个元素是 mtime，第 2 个元素是相同 mtime 的 id 的集合
     """
+    # NOTE: 由 SQLite 完成分组，每个 mtime 只返回一行，组内的 id 聚合为 JSON 数组
     if tree:
-        it = iter_descendants_bfs(con, parent_id, fields=("mtime", "id"), ensure_file=True, to_dict=False)
+        sql = """\
+WITH t(id, mtime, is_dir) AS (
+    SELECT id, mtime, is_dir FROM data WHERE parent_id=? AND is_alive
+    UNION ALL
+    SELECT data.id, data.mtime, data.is_dir FROM t JOIN data ON(t.id = data.parent_id) WHERE t.is_dir AND data.is_alive
+)
+SELECT mtime, json_group_array(id) FROM t WHERE NOT is_dir GROUP BY mtime ORDER BY mtime DESC"""
     else:
-        it = iter_descendants_bfs(con, parent_id, fields=("mtime", "id"), max_depth=1, to_dict=False)
-    d: dict[int, set[int]] = group_collect(it, factory=set)
-    return sorted(d.items(), reverse=True)
+        sql = "SELECT mtime, json_group_array(id) FROM data WHERE parent_id=? AND is_alive GROUP BY mtime ORDER BY mtime DESC"
+    return [(mtime, set(loads(ids))) for mtime, ids in query(con, sql, parent_id)]
 
 
 def dump_to_alist(
@@ -1006,10 +1093,18 @@ SELECT parent, name, is_dir, size FROM t"""
     with transact(alist_db) as cur:
         if clean:
             cur.execute("DELETE FROM x_search_nodes WHERE parent=? OR parent LIKE ? || '/%';", (dirname, dirname))
+        # NOTE: 每条 INSERT 语句一次插入多行（受限于参数个数上限），以减少语句的执行次数；整个导入在同一个事务中完成
+        batch_size = min(1024, cur.connection.getlimit(SQLITE_LIMIT_VARIABLE_NUMBER) // 4)
+        sql_insert = "INSERT INTO x_search_nodes(parent, name, is_dir, size) VALUES (?, ?, ?, ?)"
+        sql_insert_batch = sql_insert + ", (?, ?, ?, ?)" * (batch_size - 1)
         count = 0
+        execute = cur.execute
         executemany = cur.executemany
-        for items in batched(query(con, sql, locals()), 10_000):
-            executemany("INSERT INTO x_search_nodes(parent, name, is_dir, size) VALUES (?, ?, ?, ?)", items)
+        for items in batched(query(con, sql, locals()), batch_size):
+            if len(items) == batch_size:
+                execute(sql_insert_batch, tuple(chain.from_iterable(items)))
+            else:
+                executemany(sql_insert, items)
             count += len(items)
         return count
 
@@ -9,21 +9,26 @@ __all__ = [
 
 import logging
 
-from collections.abc import Iterator, Iterable, Mapping
+from collections import deque
+from collections.abc import Callable, Iterator, Iterable, Mapping
+from concurrent.futures import as_completed, Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from errno import EBUSY
-from functools import partial
-from itertools import takewhile
+from functools import lru_cache, partial
+from itertools import chain, groupby, takewhile
 from math import inf, isnan, isinf
+from operator import itemgetter
 from os import PathLike
+from pathlib import Path
 from posixpath import splitext
 from sqlite3 import connect, Connection, Cursor
+from threading import local, Lock, Semaphore
 from string import digits
 from time import sleep, time
-from typing import cast, Final, NoReturn
+from typing import Any, Final, NoReturn
 from warnings import warn
 
 from concurrenttools import run_as_thread
-from iterutils import bfs_gen
 from orjson import dumps, loads
 from p115client import check_response, normalize_attr_simple, P115Client
 from p115client.const import SUFFIX_TO_TYPE
@@ -38,7 +43,7 @@ from p115client.tool.iterdir import (
 from p115client.tool.life import (
     iter_life_behavior, IGNORE_BEHAVIOR_TYPES, BEHAVIOR_TYPE_TO_NAME, 
 )
-from sqlitetools import execute, find, upsert_items, AutoCloseConnection
+from sqlitetools import execute, find, transact, AutoCloseConnection
 
 from .query import (
     get_dir_count, has_id, iter_descendants_bfs, iter_existing_id, 
@@ -50,6 +55,10 @@ from .query import (
 MTIME_BEHAVIOR_TYPES: Final = frozenset((1, 2, 14, 17, 18, 20))
 # NOTE: 需要 ctime 的 115 生活事件类型集
 CTIME_BEHAVIOR_TYPES: Final = frozenset((1, 2, 14, 17, 18))
+# NOTE: data 表的 updated_at 字段所用的时区（UTC+8）
+UPDATED_AT_TZ: Final = timezone(timedelta(hours=8))
+# NOTE: `initdb` 所建立的表结构的版本号，修改了表、索引或触发器后，需要增加此值
+SCHEMA_VERSION: Final = 4
 # NOTE: 初始化日志对象
 logger = logging.Logger("115-updatedb", level=logging.INFO)
 handler = logging.StreamHandler()
@@ -60,20 +69,50 @@ handler.setFormatter(logging.Formatter(
 logger.addHandler(handler)
 
 
+def get_updated_at() -> str:
+    """获取当前时间，作为 data 表的 updated_at 字段的值，格式与此字段的默认值一致
+
+    :return: 形如 '2024-01-01T08:00:00.000+08:00' 的字符串
+    """
+    return datetime.now(UPDATED_AT_TZ).isoformat(timespec="milliseconds")
+
+
 def initdb(con: Connection | Cursor, /, disable_event: bool = False) -> Cursor:
     """初始化数据库，会尝试创建一些表、索引、触发器等，并把表的 "journal_mode" 改为 WAL (write-ahead-log)
 
+    .. note::
+        建表完成后，会把 `SCHEMA_VERSION` 和 `disable_event` 一起记入 "user_version"，
+        如果下次打开时两者都没变，则只设置 PRAGMA，跳过建表
+
     :param con: 数据库连接或游标
+    :param disable_event: 是否关闭 event 表的数据收集
 
     :return: 游标
     """
-    sql = """\
+    pragma_sql = """\
 -- 修改日志模式为 WAL (write-ahead-log)
 PRAGMA journal_mode = WAL;
 
+-- WAL 模式下，NORMAL 已能保证数据库不会损坏，且每次提交时不必 fsync
+PRAGMA synchronous = NORMAL;
+
+-- 临时表和索引（例如排序、分组时所用）保存在内存中
+PRAGMA temp_store = MEMORY;
+
+-- 内存映射 256 MB，页缓存 64 MB
+PRAGMA mmap_size = 268435456;
+PRAGMA cache_size = -65536;
+
+-- WAL 文件累计 10000 页才执行一次自动检查点
+PRAGMA wal_autocheckpoint = 10000;
+
 -- 允许触发器递归触发
 PRAGMA recursive_triggers = ON;
-
+"""
+    version = SCHEMA_VERSION << 1 | bool(disable_event)
+    if con.execute("PRAGMA user_version").fetchone()[0] == version:
+        return con.executescript(pragma_sql)
+    sql = """\
 -- data 表，用来保存数据
 CREATE TABLE IF NOT EXISTS data (
     id INTEGER NOT NULL PRIMARY KEY,   -- 文件或目录的 id
@@ -89,8 +128,7 @@ CREATE TABLE IF NOT EXISTS data (
     is_collect INTEGER NOT NULL DEFAULT 0, -- 是否已被标记为违规
     is_alive INTEGER NOT NULL DEFAULT 1 CHECK(is_alive IN (0, 1)),   -- 是否存活中（未被移除）
     extra BLOB DEFAULT NULL,           -- 额外的数据
-    updated_at DATETIME DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+08:00', 'now', '+8 hours')), -- 最近一次更新时间
-    _triggered INTEGER NOT NULL DEFAULT 0 -- 是否执行过触发器
+    updated_at DATETIME DEFAULT (strftime('%Y-%m-%dT%H:%M:%f+08:00', 'now', '+8 hours')) -- 最近一次更新时间
 );
 
 -- life 表，用来收集 115 生活事件
@@ -147,9 +185,21 @@ BEGIN
 END;
 
 -- 索引
-CREATE INDEX IF NOT EXISTS idx_data_pid ON data(parent_id);
+-- NOTE: 按 parent_id 查找子节点时，只按 parent_id 定位（条件写作 `is_alive` 而非 `is_alive=1`，所以不会继续按 is_alive 缩小范围），
+--       但 is_alive、is_dir、mtime（以及作为 rowid 的 id）都可直接从此索引读取并过滤，不必回表；
+--       `select_mtime_groups` 的 GROUP BY mtime 仍需临时 B 树排序
+DROP INDEX IF EXISTS idx_data_pid;
+CREATE INDEX IF NOT EXISTS idx_data_pid_scan ON data(parent_id, is_alive, is_dir, mtime);
+-- NOTE: 按 parent_id 查找子目录时，idx_data_pid_scan 已能直接给出结果，不再另建部分索引，以免增加写入的开销
+DROP INDEX IF EXISTS idx_data_subdir;
+-- NOTE: 按 (parent_id, name) 逐级查找路径时（例如 p115servedb 的 FUSE 挂载），每一级都是一次索引查找
+CREATE INDEX IF NOT EXISTS idx_data_pid_name ON data(parent_id, name);
+-- NOTE: 只收录目录的部分索引，`update_stared_dirs` 查询目录的最大 mtime 时，只需读取此索引的最后一项
+CREATE INDEX IF NOT EXISTS idx_data_dir_mtime ON data(mtime) WHERE is_dir;
 CREATE INDEX IF NOT EXISTS idx_data_pc ON data(pickcode);
 CREATE INDEX IF NOT EXISTS idx_data_sha1 ON data(sha1);
+-- NOTE: 只收录存活的文件的部分索引，查找重复文件时按 (sha1, size) 分组，可以只扫描此索引
+CREATE INDEX IF NOT EXISTS idx_data_sha1_size ON data(sha1, size) WHERE NOT is_dir AND is_alive;
 CREATE INDEX IF NOT EXISTS idx_data_name ON data(name);
 CREATE INDEX IF NOT EXISTS idx_data_utime ON data(updated_at);
 CREATE INDEX IF NOT EXISTS idx_life_create ON life(create_time);
@@ -175,10 +225,7 @@ DROP TRIGGER IF EXISTS trg_data_update;
 CREATE TRIGGER trg_data_update
 AFTER UPDATE ON data 
 FOR EACH ROW
-WHEN NOT NEW._triggered
 BEGIN
-    -- 更新时间
-    UPDATE data SET updated_at = strftime('%Y-%m-%dT%H:%M:%f+08:00', 'now', '+8 hours'), _triggered=1 WHERE id = NEW.id;
     -- 移除文件
     UPDATE dirlen SET
         file_count = file_count - 1, 
@@ -219,7 +266,8 @@ BEGIN
         tree_dir_count = tree_dir_count + NEW.is_dir, 
         tree_file_count = tree_file_count + NOT NEW.is_dir
     WHERE id = NEW.parent_id;
-    INSERT INTO event(id, diff, fs) VALUES (
+    -- NOTE: 事件的创建时间直接沿用由 Python 按批次计算好的 updated_at，不再逐行调用 strftime
+    INSERT INTO event(id, diff, fs, created_at) VALUES (
         NEW.id, 
         JSON_OBJECT(
             'id', NEW.id, 
@@ -242,7 +290,8 @@ BEGIN
                 SELECT data.parent_id, '/' || REPLACE(data.name, '/', '|') || ancestors.path FROM ancestors JOIN data ON (ancestors.parent_id = data.id) WHERE ancestors.parent_id
             )
             SELECT path FROM ancestors WHERE parent_id = 0
-        ), 'op', JSON_ARRAY('add'))
+        ), 'op', JSON_ARRAY('add')), 
+        NEW.updated_at
     );
 END;
 
@@ -251,10 +300,7 @@ DROP TRIGGER IF EXISTS trg_data_update;
 CREATE TRIGGER trg_data_update
 AFTER UPDATE ON data 
 FOR EACH ROW
-WHEN NOT NEW._triggered
 BEGIN
-    -- 更新时间
-    UPDATE data SET updated_at = strftime('%Y-%m-%dT%H:%M:%f+08:00', 'now', '+8 hours'), _triggered=1 WHERE id = NEW.id;
     -- 移除文件
     UPDATE dirlen SET
         file_count = file_count - 1, 
@@ -280,7 +326,8 @@ BEGIN
     -- 更新 is_alive 标记
     UPDATE dirlen SET is_alive = NEW.is_alive WHERE id = NEW.id;
     -- 写入事件
-    INSERT INTO event(id, old, diff, fs)
+    -- NOTE: 如果此次更新设置了 updated_at，则作为事件的创建时间，否则才调用 strftime
+    INSERT INTO event(id, old, diff, fs, created_at)
     SELECT *, (
         WITH t(event) AS (
             VALUES 
@@ -316,52 +363,58 @@ BEGIN
                 )
             END
         ), 'op', JSON(op.op)) FROM op WHERE JSON_ARRAY_LENGTH(op.op)
+    ), (
+        CASE 
+            WHEN NEW.updated_at IS NOT OLD.updated_at THEN NEW.updated_at 
+            ELSE strftime('%Y-%m-%dT%H:%M:%f+08:00', 'now', '+8 hours') 
+        END
     )
     FROM (
-        WITH data(id, old, new) AS (
-            SELECT
-                NEW.id, 
-                JSON_OBJECT(
-                    'id', OLD.id, 
-                    'parent_id', OLD.parent_id, 
-                    'pickcode', OLD.pickcode, 
-                    'sha1', OLD.sha1, 
-                    'name', OLD.name, 
-                    'size', OLD.size, 
-                    'is_dir', OLD.is_dir, 
-                    'type', OLD.type, 
-                    'ctime', OLD.ctime, 
-                    'mtime', OLD.mtime, 
-                    'is_collect', OLD.is_collect, 
-                    'is_alive', OLD.is_alive
-                ) AS old, 
-                JSON_OBJECT(
-                    'id', NEW.id, 
-                    'parent_id', NEW.parent_id, 
-                    'pickcode', NEW.pickcode, 
-                    'sha1', NEW.sha1, 
-                    'name', NEW.name, 
-                    'size', NEW.size, 
-                    'is_dir', NEW.is_dir, 
-                    'type', NEW.type, 
-                    'ctime', NEW.ctime, 
-                    'mtime', NEW.mtime, 
-                    'is_collect', NEW.is_collect, 
-                    'is_alive', NEW.is_alive
-                ) AS new
-        ), old(key, value) AS (
-            SELECT tbl.key, tbl.value FROM data, JSON_EACH(data.old) AS tbl
-        ), new(key, value) AS (
-            SELECT tbl.key, tbl.value FROM data, JSON_EACH(data.new) AS tbl
-        ), diff(diff) AS (
-            SELECT JSON_GROUP_OBJECT(key, new.value)
-            FROM old JOIN new USING (key)
-            WHERE old.value != new.value
+        -- NOTE: 逐个字段直接比较新旧值，只把有变化的字段聚合为 diff，不必先构造 2 个 JSON 对象再用 JSON_EACH 拆开、连接
+        WITH field(key, old, new) AS (
+            VALUES 
+                ('id', OLD.id, NEW.id), 
+                ('parent_id', OLD.parent_id, NEW.parent_id), 
+                ('pickcode', OLD.pickcode, NEW.pickcode), 
+                ('sha1', OLD.sha1, NEW.sha1), 
+                ('name', OLD.name, NEW.name), 
+                ('size', OLD.size, NEW.size), 
+                ('is_dir', OLD.is_dir, NEW.is_dir), 
+                ('type', OLD.type, NEW.type), 
+                ('ctime', OLD.ctime, NEW.ctime), 
+                ('mtime', OLD.mtime, NEW.mtime), 
+                ('is_collect', OLD.is_collect, NEW.is_collect), 
+                ('is_alive', OLD.is_alive, NEW.is_alive)
+        ), diff(diff, n) AS (
+            SELECT JSON_GROUP_OBJECT(key, new), COUNT(1) FROM field WHERE old IS NOT new
         )
-        SELECT data.id, data.old, diff.diff FROM data, diff WHERE data.old != data.new
+        SELECT
+            NEW.id AS id, 
+            JSON_OBJECT(
+                'id', OLD.id, 
+                'parent_id', OLD.parent_id, 
+                'pickcode', OLD.pickcode, 
+                'sha1', OLD.sha1, 
+                'name', OLD.name, 
+                'size', OLD.size, 
+                'is_dir', OLD.is_dir, 
+                'type', OLD.type, 
+                'ctime', OLD.ctime, 
+                'mtime', OLD.mtime, 
+                'is_collect', OLD.is_collect, 
+                'is_alive', OLD.is_alive
+            ) AS old, 
+            diff 
+        FROM diff WHERE n
     );
 END;"""
-    return con.executescript(sql)
+    # NOTE: 旧版本的 data 表有 _triggered 字段，触发器已不再引用它，在重建触发器后删除
+    if con.execute("SELECT 1 FROM pragma_table_info('data') WHERE name='_triggered'").fetchone():
+        sql += """
+ALTER TABLE data DROP COLUMN _triggered;"""
+    sql += f"""
+PRAGMA user_version = {version:d};"""
+    return con.executescript(pragma_sql + sql)
 
 
 def kill_items(
@@ -380,14 +433,101 @@ def kill_items(
 
     :return: 游标
     """
-    if isinstance(ids, int):
-        cond = f"id = {ids:d}"
-    else:
-        cond = "id IN (%s)" % (",".join(map(str, ids)) or "NULL")
-    sql = "UPDATE data SET _triggered=0, is_alive=0 WHERE " + cond
+    sql = "UPDATE data SET is_alive=0, updated_at=? WHERE id=?"
     if where:
         sql += " AND (%s)" % where
-    return execute(con, sql, commit=commit)
+    updated_at = get_updated_at()
+    if isinstance(ids, int):
+        return execute(con, sql, (updated_at, ids), commit=commit)
+    # NOTE: 同一条预编译语句逐个绑定 id，避免拼接出巨大的 IN (...) 语句
+    params = ((updated_at, id) for id in ids)
+    if commit:
+        with transact(con) as cur:
+            cur.executemany(sql, params)
+        return cur
+    return con.executemany(sql, params)
+
+
+@lru_cache(64)
+def _upsert_data_sql(keys: tuple[str, ...], /) -> str:
+    "生成 data 表的 upsert 语句，相同的字段组合只生成一次"
+    return "INSERT INTO data(%s) VALUES (%s) ON CONFLICT(id) DO UPDATE SET %s" % (
+        ", ".join(keys), 
+        ", ".join("?" * len(keys)), 
+        ", ".join(f"{k}=excluded.{k}" for k in keys if k != "id"), 
+    )
+
+
+def upsert_data(
+    con: Connection | Cursor, 
+    items: Iterable[Mapping], 
+    /, 
+    extras: None | Mapping = None, 
+    commit: bool = False, 
+) -> Cursor:
+    """批量更替 data 表的数据，把字段相同的相邻数据归为一批，用同一条预编译语句 executemany
+
+    :param con: 数据库连接或游标
+    :param items: 一组数据（如 `normalize_attr` 的返回值）
+    :param extras: 额外的字段和值，会写入每一条数据，与数据中的同名字段冲突时，以此为准
+    :param commit: 是否提交
+
+    :return: 游标
+    """
+    if extras:
+        extra_keys = tuple(extras)
+        extra_values = tuple(extras.values())
+    else:
+        extra_keys = extra_values = ()
+    def execute_all(cur):
+        for keys, group in groupby(items, key=tuple):
+            if extra_keys:
+                keys = tuple(k for k in keys if k not in extra_keys)
+            if len(keys) == 1:
+                getter = lambda a, k=keys[0]: (a[k],)
+            else:
+                getter = itemgetter(*keys)
+            cur.executemany(
+                _upsert_data_sql(keys + extra_keys), 
+                (getter(a) + extra_values for a in group), 
+            )
+        return cur
+    if commit:
+        with transact(con) as cur:
+            return execute_all(cur)
+    if isinstance(con, Connection):
+        return execute_all(con.cursor())
+    return execute_all(con)
+
+
+def upsert_ancestors(
+    con: Connection | Cursor, 
+    ancestors: list[dict], 
+    /, 
+    commit: bool = False, 
+) -> None | Cursor:
+    """更替一组祖先（目录）节点，但跳过数据库中已存在且 parent_id 和 name 都不变的节点
+
+    :param con: 数据库连接或游标
+    :param ancestors: 祖先节点的简略信息（含 "id"、"parent_id"、"name"）列表
+    :param commit: 是否提交
+
+    :return: 如果没有需要更替的节点，则返回 None，否则返回游标
+    """
+    # NOTE: 每拉取一个目录都会得到它的全部祖先节点，而它们绝大多数都没有变化，先用一次查询筛掉，以免反复更替
+    known = set(con.execute(
+        "SELECT id, parent_id, name FROM data WHERE id IN (SELECT value FROM json_each(?)) AND is_alive AND is_dir", 
+        (dumps([a["id"] for a in ancestors]).decode("ascii"),), 
+    ))
+    changed = [a for a in ancestors if (a["id"], a["parent_id"], a["name"]) not in known]
+    if not changed:
+        return None
+    return upsert_data(
+        con, 
+        changed, 
+        extras={"is_alive": 1, "is_dir": 1, "updated_at": get_updated_at()}, 
+        commit=commit, 
+    )
 
 
 def sort(
@@ -408,8 +548,10 @@ def sort(
         try:
             return depth_d[id]
         except KeyError:
+            # NOTE: 按需计算并缓存，同一条祖先链只会向上走一次
             if id in d:
-                return 1 + depth(d[id])
+                depth_d[id] = n = 1 + depth(d[id])
+                return n
             return 0
     data.sort(key=lambda a: depth(a["id"]), reverse=reverse)
     return data
@@ -484,12 +626,14 @@ def update_stared_dirs(
     con: Connection | Cursor, 
     /, 
     client: P115Client, 
+    submit: None | Callable[[Callable[[Connection | Cursor], Any]], Any] = None, 
     **request_kwargs, 
 ) -> list[dict]:
     """从网上增量拉取目录数据，并更新到数据库
 
     :param con: 数据库连接或游标
     :param client: 115 网盘客户端对象
+    :param submit: 用来提交数据库写入任务的函数，任务是一个接收数据库连接作为唯一参数的函数，如果为 None，则直接用 `con` 写入
     :param request_kwargs: 其它 http 请求参数，会传给具体的请求函数，默认的是 httpx，可用参数 request 进行设置
 
     :return: 拉取下来的新增或更新的目录的信息字典列表
@@ -526,16 +670,23 @@ def update_stared_dirs(
                 data_add(attr)
     if data:
         ancestors = load_ancestors(con, client, data)
-        upsert_items(con, ancestors, extras={"_triggered": 0}, commit=True)
-        upsert_items(con, sort(data), extras={"_triggered": 0}, commit=True)
+        sort(data)
+        def write(con):
+            with transact(con) as cur:
+                upsert_data(cur, ancestors, extras={"updated_at": get_updated_at()})
+                upsert_data(cur, data, extras={"updated_at": get_updated_at()})
+        if submit is None:
+            write(con)
+        else:
+            submit(write)
     return data
 
 
-def is_timeouterror(exc: Exception) -> bool:
-    "判断一个错误类型是不是超时错误"
-    if isinstance(exc, TimeoutError):
+@lru_cache(64)
+def _is_timeouterror_type(exctype: type, /) -> bool:
+    "判断一个异常类型是不是超时错误，同一类型只需沿 mro 查找一次"
+    if issubclass(exctype, TimeoutError):
         return True
-    exctype = type(exc)
     for exctype in exctype.mro():
         if exctype is Exception:
             break
@@ -544,6 +695,12 @@ def is_timeouterror(exc: Exception) -> bool:
     return False
 
 
+def is_timeouterror(exc: Exception) -> bool:
+    "判断一个错误类型是不是超时错误"
+    # NOTE: 按名字匹配，不必依赖具体的 http 库，结果按异常类型缓存
+    return _is_timeouterror_type(type(exc))
+
+
 def iterdir(
     client: P115Client, 
     cid: int = 0, 
@@ -574,7 +731,7 @@ def iterdir(
         4. 迭代器，用来获取数据
     """
     seen: set[int] = set()
-    seen_add = seen.add
+    seen_update = seen.update
     ancestors: list[dict] = []
     def iterate():
         nonlocal count
@@ -609,15 +766,16 @@ def iterdir(
             if not n:
                 count = int(resp["count"])
                 yield
-            for attr in map(normalize_attr, resp["data"]):
-                fid = cast(int, attr["id"])
-                if fid in seen:
-                    raise BusyOSError(
-                        EBUSY, 
-                        f"duplicate id found, means that some unpulled items have been updated: cid={cid}", 
-                    )
-                seen_add(fid)
-                yield attr
+            # NOTE: 整页一次性加入 seen，再用集合大小的变化来判断是否有重复，不必逐个检查
+            data = list(map(normalize_attr, resp["data"]))
+            size = len(seen)
+            seen_update(attr["id"] for attr in data)
+            if len(seen) - size != len(data):
+                raise BusyOSError(
+                    EBUSY, 
+                    f"duplicate id found, means that some unpulled items have been updated: cid={cid}", 
+                )
+            yield from data
     it = iterate()
     next(it)
     return count, ancestors, seen, it
@@ -631,6 +789,7 @@ def diff_dir(
     count: int = -1, 
     refresh: bool = False, 
     tree: bool = False, 
+    submit: None | Callable[[Callable[[Connection | Cursor], Any]], Any] = None, 
     **request_kwargs, 
 ) -> tuple[bool, list[dict], list[int]]:
     """拉取数据，确定哪些记录需要移除或更替
@@ -641,10 +800,13 @@ def diff_dir(
     :param count: 文件总数
     :param refresh: 执行全量拉取
     :param tree: 如果为 True，则比对目录树，但仅对文件，即叶子节点，如果为 False，则比对所有直接（1 级）子节点，包括文件和目录
+    :param submit: 用来提交数据库写入任务的函数，任务是一个接收数据库连接作为唯一参数的函数，如果为 None，则直接用 `con` 写入
     :param request_kwargs: 其它 http 请求参数，会传给具体的请求函数，默认的是 httpx，可用参数 request 进行设置
 
     :return: 3 元组，1) 是否被全量拉取，2) 待更替的数据列表，3) 待移除的 id 列表
     """
+    if submit is None:
+        submit = lambda write: write(con)
     upsert_list: list[dict] = []
     remove_list: list[int] = []
     if refresh or not ((dirlen := get_dir_count(con, id)) and dirlen["tree_file_count"]):
@@ -657,16 +819,19 @@ def diff_dir(
             _, ancestors, _, data_it = iterdir(client, id, count=count, cooldown=0.5, **request_kwargs)
         try:
             upsert_list.extend(data_it)
-        finally:
+            upsert_dir_list: list[dict] = future2.result()
+        except:
             if ancestors:
-                upsert_items(con, ancestors, extras={"is_alive": 1, "is_dir": 1, "_triggered": 0}, commit=True)
-        upsert_dir_list: list[dict] = future2.result()
+                submit(lambda con: upsert_ancestors(con, ancestors, commit=True))
+            raise
         alive_ids = {a["id"] for a in upsert_list}
         alive_ids.update(a["id"] for a in upsert_dir_list)
         alive_ids.update(a["id"] for a in ancestors)
         remove_list.extend(future1.result() - alive_ids)
+        # NOTE: 祖先节点和子孙目录合并为一批，只执行一次 upsert，共用一次提交
+        upsert_dir_list.extend({**a, "is_dir": 1, "is_alive": 1} for a in ancestors)
         sort(upsert_dir_list)
-        upsert_items(con, upsert_dir_list, commit=True)
+        submit(lambda con: upsert_data(con, upsert_dir_list, extras={"updated_at": get_updated_at()}, commit=True))
         return True, upsert_list, remove_list
     future = run_as_thread(select_mtime_groups, con, id, tree=tree)
     if tree:
@@ -680,6 +845,7 @@ def diff_dir(
     result = not tree, upsert_list, remove_list
     try:
         if remains:
+            # NOTE: 每组 id 都是集合，判断成员和删除都是 O(1)，最后用集合差（在 C 层）找出未被拉取到的 id
             his_it = iter(groups)
             his_mtime, his_ids = next(his_it)
         for n, attr in enumerate(data_it, 1):
@@ -707,7 +873,50 @@ def diff_dir(
         return result
     finally:
         if ancestors:
-            upsert_items(con, ancestors, extras={"is_alive": 1, "is_dir": 1, "_triggered": 0}, commit=True)
+            submit(lambda con: upsert_ancestors(con, ancestors, commit=True))
+
+
+def _normalize_attr_app(
+    info: Mapping, 
+    /, 
+    _int=int, 
+    _splitext=splitext, 
+    _lower=str.lower, 
+    _suffix_to_type=SUFFIX_TO_TYPE.get, 
+) -> dict:
+    # NOTE: 这是 `normalize_attr_app(info, simple=True)` 的特化版本，专门处理 app 接口（含 "fn" 字段）的数据，
+    #       这是最主要的数据来源，每个文件都要调用一次，所以把全局名字都绑定为局部变量
+    get = info.get
+    is_dir = info["fc"] == "0"
+    name = info["fn"]
+    attr: dict = {
+        "is_dir": is_dir, 
+        "id": _int(info["fid"]), 
+        "parent_id": _int(info["pid"]), 
+        "name": name, 
+        "sha1": get("sha1") or "", 
+        "size": _int(get("fs") or 0), 
+    }
+    if "pc" in info:
+        attr["pickcode"] = info["pc"]
+    if "ic" in info:
+        attr["is_collect"] = _int(info["ic"])
+    if "uppt" in info:
+        attr["ctime"] = _int(info["uppt"])
+    if "upt" in info:
+        attr["mtime"] = _int(info["upt"])
+    if is_dir:
+        attr["type"] = 0
+    elif (thumb := get("thumb")) and thumb.startswith("?"):
+        attr["type"] = 2
+    elif "muc" in info:
+        attr["type"] = 3
+    elif get("isv") or "def" in info or "def2" in info or "v_img" in info:
+        attr["type"] = 4
+    else:
+        attr["type"] = _suffix_to_type(_lower(_splitext(name)[1])) or 99
+    attr["is_alive"] = 1
+    return attr
 
 
 def normalize_attr(info: Mapping, /) -> dict:
@@ -717,6 +926,8 @@ def normalize_attr(info: Mapping, /) -> dict:
 
     :return: 经过规范化后的数据
     """
+    if "fn" in info:
+        return _normalize_attr_app(info)
     attr = normalize_attr_simple(info)
     attr["is_alive"] = 1
     return attr
@@ -743,6 +954,7 @@ def _init_client(
             check_same_thread=False, 
             factory=AutoCloseConnection, 
             timeout=inf, 
+            cached_statements=256, 
         )
         initdb(con, disable_event=disable_event)
     return client, con
@@ -836,8 +1048,8 @@ def updatedb_life_iter(
                 except FileNotFoundError:
                     pass
                 if ancestors:
-                    upsert_items(con, ancestors, extras={"is_alive": 1, "is_dir": 1, "_triggered": 0}, commit=True)
-            upsert_items(con, attr, extras={"_triggered": 0}, commit=True)
+                    upsert_ancestors(con, ancestors, commit=True)
+            upsert_data(con, (attr,), extras={"updated_at": get_updated_at()}, commit=True)
         execute(
             con, 
             "INSERT OR IGNORE INTO life(id, data, create_time) VALUES (?,?,?)", 
@@ -893,6 +1105,7 @@ def updatedb_one(
     /, 
     count: int = -1, 
     refresh: bool = False, 
+    submit: None | Callable[[Callable[[Connection | Cursor], Any]], Any] = None, 
     **request_kwargs, 
 ) -> tuple[int, int]:
     """更新一个目录
@@ -902,14 +1115,22 @@ def updatedb_one(
     :param id: 要拉取的目录 id
     :param count: 文件总数
     :param refresh: 是否全量更新
+    :param submit: 用来提交数据库写入任务的函数，任务是一个接收数据库连接作为唯一参数的函数，如果为 None，则直接用 `con` 写入
     :param request_kwargs: 其它 http 请求参数，会传给具体的请求函数，默认的是 httpx，可用参数 request 进行设置
 
     :return: 2 元组，1) 已更替的数据列表，2) 已移除的 id 列表
     """
     client, con = _init_client(client, dbfile)
-    _, to_upsert, to_remove = diff_dir(con, client, id, refresh=refresh, count=count, **request_kwargs)
-    upsert_items(con, to_upsert, extras={"_triggered": 0}, commit=True)
-    kill_items(con, to_remove, commit=True)
+    _, to_upsert, to_remove = diff_dir(con, client, id, refresh=refresh, count=count, submit=submit, **request_kwargs)
+    def write(con):
+        # NOTE: 更替和移除在同一个事务中完成，只提交一次
+        with transact(con) as cur:
+            upsert_data(cur, to_upsert, extras={"updated_at": get_updated_at()})
+            kill_items(cur, to_remove)
+    if submit is None:
+        write(con)
+    else:
+        submit(write)
     return len(to_upsert), len(to_remove)
 
 
@@ -921,6 +1142,7 @@ def updatedb_tree(
     count: int = -1, 
     no_dir_moved: bool = True, 
     refresh: bool = False, 
+    submit: None | Callable[[Callable[[Connection | Cursor], Any]], Any] = None, 
     **request_kwargs, 
 ) -> tuple[int, int]:
     """更新一个目录树
@@ -931,12 +1153,13 @@ def updatedb_tree(
     :param count: 文件总数
     :param no_dir_moved: 是否无目录被移动或改名，如果为 True，则拉取会快一些
     :param refresh: 是否全量更新
+    :param submit: 用来提交数据库写入任务的函数，任务是一个接收数据库连接作为唯一参数的函数，如果为 None，则直接用 `con` 写入
     :param request_kwargs: 其它 http 请求参数，会传给具体的请求函数，默认的是 httpx，可用参数 request 进行设置
 
     :return: 2 元组，1) 已更替的数据列表，2) 已移除的 id 列表
     """
     client, con = _init_client(client, dbfile)
-    refresh, to_upsert, to_remove = diff_dir(con, client, id, count=count, refresh=refresh, tree=True, **request_kwargs)
+    refresh, to_upsert, to_remove = diff_dir(con, client, id, count=count, refresh=refresh, tree=True, submit=submit, **request_kwargs)
     to_recall: list[dict] = []
     if not refresh and to_remove and not no_dir_moved:
         pairs = dict(iter_id_to_parent_id(con, to_remove))
@@ -961,23 +1184,28 @@ def updatedb_tree(
         if pairs:
             to_remove.extend(pairs)
     upserted = len(to_upsert) + len(to_recall)
-    if upserted:
-        if not refresh:
-            ancestors = load_ancestors(
-                con, 
-                client, 
-                to_upsert + to_recall, 
-                all_are_files=True, 
-                refresh=not no_dir_moved, 
-                use_star=True, 
-            )
-            upsert_items(con, ancestors, extras={"_triggered": 0}, commit=True)
-            upserted += len(ancestors)
-        upsert_items(con, to_upsert, extras={"_triggered": 0}, commit=True)
-        if to_recall:
-            upsert_items(con, to_recall, extras={"_triggered": 0}, commit=True)
-    if to_remove:
-        kill_items(con, to_remove, commit=True)
+    ancestors: list[dict] = []
+    if upserted and not refresh:
+        ancestors = load_ancestors(
+            con, 
+            client, 
+            to_upsert + to_recall, 
+            all_are_files=True, 
+            refresh=not no_dir_moved, 
+            use_star=True, 
+        )
+        upserted += len(ancestors)
+    def write(con):
+        # NOTE: 祖先节点、待更替和待召回的数据一并交给 upsert_data（字段相同的相邻数据共用一条语句），
+        #       和移除一起在同一个事务中完成，只提交一次
+        with transact(con) as cur:
+            upsert_data(cur, chain(ancestors, to_upsert, to_recall), extras={"updated_at": get_updated_at()})
+            if to_remove:
+                kill_items(cur, to_remove)
+    if submit is None:
+        write(con)
+    else:
+        submit(write)
     return upserted, len(to_remove)
 
 
@@ -993,6 +1221,7 @@ def updatedb(
     interval: int | float = 0.5, 
     logger = logger, 
     disable_event: bool = False, 
+    max_workers: int = 1, 
     **request_kwargs, 
 ):
     """批量执行一组任务，任务为更新单个目录或者目录树的文件信息
@@ -1008,6 +1237,7 @@ def updatedb(
     :param interval: 两个批处理任务至少需要间隔的时间（以启动前那一刻作为计算依据）
     :param logger: 日志对象，如果为 None，则不输出日志
     :param disable_event: 是否关闭 event 表的数据收集
+    :param max_workers: 并发拉取目录树的最大线程数，仅对不需要拆分的目录树生效，如果 <= 1，则不并发
     :param request_kwargs: 其它 http 请求参数，会传给具体的请求函数，默认的是 httpx，可用参数 request 进行设置
     """
     client, con = _init_client(client, dbfile, disable_event=disable_event)
@@ -1054,72 +1284,220 @@ def updatedb(
             except Exception as e:
                 if is_timeouterror(e):
                     if logger is not None:
-                        logger.info("[\x1b[1;37;43mSTAT\x1b[0m] \x1b[1m%d\x1b[0m, too big, since statistics timeout, consider the size as \x1b[1;3minf\x1b[0m", id)
+                        logger.info("[\x1b[1;37;43mSTAT\x1b[0m] \x1b[1m%d\x1b[0m, too big, since statistics timeout, consider the size as \x1b[1;3minf\x1b[0m", cid)
                     return float("inf")
                 raise
-    gen = bfs_gen(iter(top_ids), unpack_iterator=True) # type: ignore
-    send = gen.send
-    start_time: float = 0
-    for id in gen:
-        if start_time and interval > 0 and (diff := start_time + interval - time()) > 0:
-            sleep(diff)
-        if id in seen:
-            if logger is not None:
-                logger.warning("[\x1b[1;33mSKIP\x1b[0m] already processed: %s", id)
-            continue
-        if auto_splitting_threshold == 0:
-            need_to_split_tasks = True
-        elif auto_splitting_threshold < 0:
-            need_to_split_tasks = False
-        elif recursive:
-            count = get_file_count_in_tree(id)
-            if not count:
+        # NOTE: 拆分出来的子目录，预先并发统计文件数，以便和目录的拉取重叠进行
+        prober = ThreadPoolExecutor(max_workers=16, thread_name_prefix="updatedb-prober")
+        count_futures: dict[int, Future] = {}
+    # NOTE: 如果数据库是文件，则数据库写入在单独的线程中，用它专属的连接依次执行，最多积压 4 个，以便和下一批数据的拉取重叠进行；
+    #       否则（例如内存数据库）只有 `con` 这一个连接，直接写入
+    dbpath = con.execute("PRAGMA database_list").fetchone()[2]
+    writer: None | ThreadPoolExecutor = None
+    pending_writes: deque[tuple[int, Future]] = deque()
+    write_lock = Lock()
+    if dbpath:
+        wcon = connect(
+            dbpath, 
+            check_same_thread=False, 
+            factory=AutoCloseConnection, 
+            timeout=inf, 
+            cached_statements=256, 
+        )
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="updatedb-writer")
+    # NOTE: 每个写入任务都带上所属目录的 id，失败时立即用这个 id 记录日志，
+    #       之后在 submit 或 flush 中抛出时，异常也会附上这个 id，而不是归咎于当时正在拉取的目录
+    def on_write_done(id: int, fu: Future, /):
+        if logger is not None and not fu.cancelled() and (exc := fu.exception()) is not None:
+            logger.error("[\x1b[1;31mFAIL\x1b[0m] failed to write: %s", id, exc_info=exc)
+    write_error: None | BaseException = None
+    def wait_write(id: int, fu: Future, /):
+        nonlocal write_error
+        try:
+            fu.result()
+        except BaseException as e:
+            e.add_note(f"failed to write the data of directory {id} into the database")
+            write_error = e
+            raise
+    def submit(write: Callable[[Connection | Cursor], Any], /, id: int):
+        if writer is None:
+            write(con)
+            return
+        with write_lock:
+            while len(pending_writes) >= 4:
+                wait_write(*pending_writes.popleft())
+            fu = writer.submit(write, wcon)
+            fu.add_done_callback(partial(on_write_done, id))
+            pending_writes.append((id, fu))
+    def flush():
+        with write_lock:
+            while pending_writes:
+                wait_write(*pending_writes.popleft())
+    # NOTE: 如果数据库是文件，则每个拉取线程（包括主线程）使用单独的只读连接进行读取，写入全部由写入线程的连接完成
+    thread_local = local()
+    read_cons: list[Connection] = []
+    def get_con() -> Connection | Cursor:
+        if not dbpath:
+            return con
+        try:
+            return thread_local.con
+        except AttributeError:
+            thread_local.con = con_ = connect(
+                Path(dbpath).as_uri() + "?mode=ro", 
+                uri=True, 
+                check_same_thread=False, 
+                factory=AutoCloseConnection, 
+                timeout=inf, 
+                cached_statements=256, 
+            )
+            read_cons.append(con_)
+            return con_
+    # NOTE: 不需要拆分的目录树可以并发拉取，以掩盖 http 请求的往返耗时，并用信号量限制在途任务数，
+    #       但如果数据库不是文件，则所有线程只能共用 `con`，所以不并发
+    traversal_pool: None | ThreadPoolExecutor = None
+    if recursive and max_workers > 1 and writer is not None:
+        traversal_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="updatedb-traversal")
+        in_flight = Semaphore(max_workers * 2)
+        pending_trees: dict[int, Future] = {}
+        def run_tree(id: int, /) -> int:
+            try:
+                while True:
+                    start_time = time()
+                    try:
+                        upserted, removed = updatedb_tree(client, get_con(), id, refresh=refresh, no_dir_moved=no_dir_moved, submit=partial(submit, id=id), **request_kwargs)
+                    except FileNotFoundError:
+                        submit(lambda con, id=id: kill_items(con, id, commit=True), id=id)
+                        if logger is not None:
+                            logger.warning("[\x1b[1;33mSKIP\x1b[0m] not found: %s", id)
+                    except NotADirectoryError:
+                        submit(lambda con, id=id: kill_items(con, id, where="is_dir", commit=True), id=id)
+                        if logger is not None:
+                            logger.warning("[\x1b[1;33mSKIP\x1b[0m] not a directory: %s", id)
+                    except BusyOSError:
+                        if logger is not None:
+                            logger.warning("[\x1b[1;35mREDO\x1b[0m] directory is busy updating: %s", id)
+                        if interval > 0:
+                            sleep(interval)
+                        continue
+                    except BaseException as e:
+                        # NOTE: 写入任务的失败已由 on_write_done 按所属的 id 记录过
+                        if logger is not None and e is not write_error:
+                            logger.exception("[\x1b[1;31mFAIL\x1b[0m] %s", id)
+                        raise
+                    else:
+                        if logger is not None:
+                            logger.info(
+                                "[\x1b[1;32mGOOD\x1b[0m] \x1b[1m%s\x1b[0m, upsert: %d, remove: %d, cost: %.6f s", 
+                                id, 
+                                upserted, 
+                                removed, 
+                                time() - start_time, 
+                            )
+                    break
+                return id
+            finally:
+                in_flight.release()
+        def reap_trees(wait: bool = False):
+            # NOTE: 收取已完成的目录树任务，任务成功才记入 seen，如果有任务失败，则立即抛出它的异常，从而终止整个运行
+            futures = pending_trees.values()
+            for fu in as_completed(futures) if wait else [fu for fu in futures if fu.done()]:
+                id = fu.result()
+                del pending_trees[id]
                 seen_add(id)
+    try:
+        queue: deque[int] = deque(top_ids)
+        send = queue.append
+        start_time: float = 0
+        while queue:
+            if traversal_pool is not None:
+                reap_trees()
+            id = queue.popleft()
+            if start_time and interval > 0 and (diff := start_time + interval - time()) > 0:
+                sleep(diff)
+            if id in seen or traversal_pool is not None and id in pending_trees:
+                if logger is not None:
+                    logger.warning("[\x1b[1;33mSKIP\x1b[0m] already processed: %s", id)
                 continue
-            need_to_split_tasks = count > auto_splitting_threshold
-            if logger is not None:
-                if need_to_split_tasks:
-                    logger.info(f"[\x1b[1;37;41mTELL\x1b[0m] \x1b[1m{id}\x1b[0m, \x1b[1;31mbig\x1b[0m ({count:,.0f} > {auto_splitting_threshold:,d}), will be pulled in \x1b[1;4;5;31mmulti batches\x1b[0m")
+            if auto_splitting_threshold == 0:
+                need_to_split_tasks = True
+            elif auto_splitting_threshold < 0:
+                need_to_split_tasks = False
+            elif recursive:
+                if fu := count_futures.pop(id, None):
+                    count = fu.result()
                 else:
-                    logger.info(f"[\x1b[1;37;42mTELL\x1b[0m] \x1b[1m{id}\x1b[0m, \x1b[1;32mfit\x1b[0m ({count:,.0f} <= {auto_splitting_threshold:,d}), will be pulled in \x1b[1;4;5;32mone batch\x1b[0m")
-        else:
-            need_to_split_tasks = True
-        start_time = time()
-        try:
-            logger.info(f"[\x1b[1;37;43mTELL\x1b[0m] \x1b[1m{id}\x1b[0m is running ...")
-            if need_to_split_tasks or not recursive:
-                upserted, removed = updatedb_one(client, con, id, refresh=refresh, **request_kwargs)
+                    count = get_file_count_in_tree(id)
+                if not count:
+                    seen_add(id)
+                    continue
+                need_to_split_tasks = count > auto_splitting_threshold
+                if logger is not None:
+                    if need_to_split_tasks:
+                        logger.info(f"[\x1b[1;37;41mTELL\x1b[0m] \x1b[1m{id}\x1b[0m, \x1b[1;31mbig\x1b[0m ({count:,.0f} > {auto_splitting_threshold:,d}), will be pulled in \x1b[1;4;5;31mmulti batches\x1b[0m")
+                    else:
+                        logger.info(f"[\x1b[1;37;42mTELL\x1b[0m] \x1b[1m{id}\x1b[0m, \x1b[1;32mfit\x1b[0m ({count:,.0f} <= {auto_splitting_threshold:,d}), will be pulled in \x1b[1;4;5;32mone batch\x1b[0m")
             else:
-                upserted, removed = updatedb_tree(client, con, id, refresh=refresh, no_dir_moved=no_dir_moved, **request_kwargs)
-        except FileNotFoundError:
-            kill_items(con, id, commit=True)
-            if logger is not None:
-                logger.warning("[\x1b[1;33mSKIP\x1b[0m] not found: %s", id)
-        except NotADirectoryError:
-            kill_items(con, id, where="is_dir", commit=True)
-            if logger is not None:
-                logger.warning("[\x1b[1;33mSKIP\x1b[0m] not a directory: %s", id)
-        except BusyOSError:
-            if logger is not None:
-                logger.warning("[\x1b[1;35mREDO\x1b[0m] directory is busy updating: %s", id)
-            send(id)
-        except:
-            if logger is not None:
-                logger.exception("[\x1b[1;31mFAIL\x1b[0m] %s", id)
-            raise
-        else:
-            if logger is not None:
-                logger.info(
-                    "[\x1b[1;32mGOOD\x1b[0m] \x1b[1m%s\x1b[0m, upsert: %d, remove: %d, cost: %.6f s", 
-                    id, 
-                    upserted, 
-                    removed, 
-                    time() - start_time, 
-                )
-            seen_add(id)
-            if recursive and need_to_split_tasks:
-                for cid in iter_descendants_bfs(con, id, fields="id", ensure_file=False, max_depth=1):
-                    send(cid)
+                need_to_split_tasks = True
+            if traversal_pool is not None and not need_to_split_tasks:
+                in_flight.acquire()
+                reap_trees()
+                pending_trees[id] = traversal_pool.submit(run_tree, id)
+                continue
+            start_time = time()
+            try:
+                logger.info(f"[\x1b[1;37;43mTELL\x1b[0m] \x1b[1m{id}\x1b[0m is running ...")
+                if need_to_split_tasks or not recursive:
+                    upserted, removed = updatedb_one(client, get_con(), id, refresh=refresh, submit=partial(submit, id=id), **request_kwargs)
+                else:
+                    upserted, removed = updatedb_tree(client, get_con(), id, refresh=refresh, no_dir_moved=no_dir_moved, submit=partial(submit, id=id), **request_kwargs)
+            except FileNotFoundError:
+                submit(lambda con, id=id: kill_items(con, id, commit=True), id=id)
+                if logger is not None:
+                    logger.warning("[\x1b[1;33mSKIP\x1b[0m] not found: %s", id)
+            except NotADirectoryError:
+                submit(lambda con, id=id: kill_items(con, id, where="is_dir", commit=True), id=id)
+                if logger is not None:
+                    logger.warning("[\x1b[1;33mSKIP\x1b[0m] not a directory: %s", id)
+            except BusyOSError:
+                if logger is not None:
+                    logger.warning("[\x1b[1;35mREDO\x1b[0m] directory is busy updating: %s", id)
+                send(id)
+            except BaseException as e:
+                # NOTE: 写入任务的失败已由 on_write_done 按所属的 id 记录过
+                if logger is not None and e is not write_error:
+                    logger.exception("[\x1b[1;31mFAIL\x1b[0m] %s", id)
+                raise
+            else:
+                if logger is not None:
+                    logger.info(
+                        "[\x1b[1;32mGOOD\x1b[0m] \x1b[1m%s\x1b[0m, upsert: %d, remove: %d, cost: %.6f s", 
+                        id, 
+                        upserted, 
+                        removed, 
+                        time() - start_time, 
+                    )
+                seen_add(id)
+                if recursive and need_to_split_tasks:
+                    # NOTE: 子目录要从数据库中读取，所以需要先等待写入完成
+                    flush()
+                    for cid in iter_descendants_bfs(get_con(), id, fields="id", ensure_file=False, max_depth=1):
+                        if need_calc_size and cid not in count_futures:
+                            count_futures[cid] = prober.submit(get_file_count_in_tree, cid)
+                        send(cid)
+        if traversal_pool is not None:
+            reap_trees(wait=True)
+        flush()
+    finally:
+        if traversal_pool is not None:
+            traversal_pool.shutdown(cancel_futures=True)
+        if need_calc_size:
+            prober.shutdown(cancel_futures=True)
+        # NOTE: 关闭写入线程前，会等待已提交的写入任务执行完毕
+        if writer is not None:
+            writer.shutdown()
+            wcon.close()
+        for con_ in read_cons:
+            con_.close()
 
 
 def iter_fs_event(
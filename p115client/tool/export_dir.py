@@ -11,10 +11,12 @@ __doc__ = "这个模块提供了一些和导出目录树有关的函数"
 from asyncio import sleep as async_sleep
 from collections.abc import AsyncIterable, AsyncIterator, Callable, Coroutine, Iterable, Iterator
 from functools import partial
-from io import BufferedReader, TextIOWrapper
+from io import BufferedReader, RawIOBase, TextIOWrapper
 from itertools import count
 from os import PathLike
+from queue import Full, Queue
 from re import compile as re_compile
+from threading import Event, Thread
 from time import sleep, time
 from typing import cast, overload, Any, Final, IO, Literal
 
@@ -25,6 +27,85 @@ from p115client import check_response, P115Client
 
 
 CRE_TREE_PREFIX_match: Final = re_compile(r"^(?:\| )+\|-(.*)").match
+# NOTE: 读取导出的目录树文件时的缓冲区大小（1 MB），文件可能很大，默认的 8 KB 会导致过多的系统调用或网络读取
+READ_BUFFER_SIZE: Final = 1 << 20
+
+
+class _ReadAheadReader(RawIOBase):
+    """在后台线程中预先读取 `file`，使下载和解析可以同时进行
+
+    .. note::
+        关闭时，会通知后台线程停止、关闭 `file`，并等待后台线程退出，所以 `file` 由此对象负责关闭
+
+    :param file: 打开的二进制文件（例如网络响应）
+    :param chunk_size: 每次读取的字节数
+    :param maxsize: 最多预先读取的块数
+    """
+    def __init__(self, file, /, chunk_size: int = READ_BUFFER_SIZE, maxsize: int = 8):
+        self._file = file
+        self._queue: Queue[bytes | BaseException] = Queue(maxsize)
+        self._buffer = memoryview(b"")
+        self._error: None | BaseException = None
+        self._stop = Event()
+        self._thread = Thread(target=self._fill, args=(chunk_size,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item: bytes | BaseException, /):
+        # NOTE: 队列已满时定期检查是否已被通知停止，以免后台线程一直阻塞在 put 上
+        put = self._queue.put
+        stopped = self._stop.is_set
+        while not stopped():
+            try:
+                return put(item, timeout=0.1)
+            except Full:
+                pass
+
+    def _fill(self, chunk_size: int, /):
+        read = self._file.read
+        stopped = self._stop.is_set
+        try:
+            while not stopped() and (chunk := read(chunk_size)):
+                self._put(chunk)
+        except BaseException as e:
+            if not stopped():
+                self._put(e)
+        else:
+            self._put(b"")
+
+    def close(self, /):
+        if self.closed:
+            return
+        super().close()
+        self._stop.set()
+        thread = self._thread
+        # NOTE: 先给后台线程一点时间，读完当前的块后自行退出，以免和它同时操作 file；
+        #       如果它仍阻塞在 read 上，则关闭 file 让它尽快返回
+        thread.join(1)
+        if callable(close := getattr(self._file, "close", None)):
+            close()
+        thread.join(5)
+
+    def readable(self, /) -> bool:
+        return True
+
+    def readinto(self, b, /) -> int:
+        buffer = self._buffer
+        if not buffer:
+            # NOTE: 后台线程出错后就不再往队列中放数据，所以要记住这个异常，之后每次读取都再次抛出，否则会一直阻塞在 get 上
+            if (error := self._error) is not None:
+                raise error
+            chunk = self._queue.get()
+            if isinstance(chunk, BaseException):
+                self._error = chunk
+                raise chunk
+            elif not chunk:
+                self._queue.put(b"")
+                return 0
+            buffer = memoryview(chunk)
+        n = min(len(b), len(buffer))
+        b[:n] = buffer[:n]
+        self._buffer = buffer[n:]
+        return n
 
 
 @overload
@@ -74,7 +155,7 @@ def parse_export_dir_as_dict_iter(
             }
     """
     if isinstance(file, (bytes, str, PathLike)):
-        file = open(file, encoding=encoding)
+        file = open(file, encoding=encoding, buffering=READ_BUFFER_SIZE)
         close_file = True
     def gen_step():
         it = ensure_aiter(file, threaded=True) if async_ else file
@@ -97,7 +178,7 @@ def parse_export_dir_as_dict_iter(
                 else:
                     yield Yield(stack[depth], identity=True)
                 name = m[1]
-                depth = (len(line) - len(name)) // 2 - 1
+                depth = (m.start(1) >> 1) - 1
                 item = {
                     "key": i, 
                     "parent_key": stack[depth-1]["key"], 
@@ -171,7 +252,7 @@ def parse_export_dir_as_path_iter(
     :return: 把每一行解析为一个路径，并逐次迭代返回
     """
     if isinstance(file, (bytes, str, PathLike)):
-        file = open(file, encoding=encoding)
+        file = open(file, encoding=encoding, buffering=READ_BUFFER_SIZE)
         close_file = True
     if isinstance(escape, bool):
         if escape:
@@ -210,10 +291,11 @@ def parse_export_dir_as_path_iter(
                 else:
                     yield "/" if root == "根目录" else root
                 name = m[1]
-                depth = (len(line) - len(name)) // 2 - 1
+                depth = (m.start(1) >> 1) - 1
                 if escape is not None:
                     name = escape(name)
-                path = stack[depth-1] + "/" + name
+                # NOTE: 用 f-string 一次拼接，不像 `+` 那样生成中间字符串
+                path = f"{stack[depth-1]}/{name}"
                 try:
                     stack[depth] = path
                 except IndexError:
@@ -271,7 +353,7 @@ def parse_export_dir_as_patht_iter(
     :return: 把每一行解析为一个名字列表，并逐次迭代返回
     """
     if isinstance(file, (bytes, str, PathLike)):
-        file = open(file, encoding=encoding)
+        file = open(file, encoding=encoding, buffering=READ_BUFFER_SIZE)
         close_file = True
     def gen_step():
         it = ensure_aiter(file, threaded=True) if async_ else file
@@ -300,7 +382,7 @@ def parse_export_dir_as_patht_iter(
                 else:
                     yield Yield(stack[:depth+1], identity=True)
                 name = m[1]
-                depth = (len(line) - len(name)) // 2 - from_top_root
+                depth = (m.start(1) >> 1) - from_top_root
                 try:
                     stack[depth] = name
                 except IndexError:
@@ -625,11 +707,14 @@ def export_dir_parse_iter(
                     **request_kwargs, 
                 )
             file = client.open(url, async_=async_) # type: ignore
+            reader: None | _ReadAheadReader = None
             try:
                 if async_:
                     file_wrapper: IO = AsyncTextIOWrapper(AsyncBufferedReader(file), encoding="utf-16", newline="\n")
                 else:
-                    file_wrapper = TextIOWrapper(BufferedReader(file), encoding="utf-16", newline="\n")
+                    # NOTE: 由后台线程继续下载，和解析重叠进行
+                    reader = _ReadAheadReader(file)
+                    file_wrapper = TextIOWrapper(BufferedReader(reader, READ_BUFFER_SIZE), encoding="utf-16", newline="\n")
                 yield YieldFrom(parse_iter(file_wrapper), identity=True) # type: ignore
             finally:
                 if async_:
@@ -637,6 +722,9 @@ def export_dir_parse_iter(
                         yield aclose
                     elif callable(close := getattr(file, "close", None)):
                         yield ensure_async(close, threaded=True)
+                elif reader is not None:
+                    # NOTE: 先停止后台线程，再关闭 file
+                    reader.close()
                 elif callable(close := getattr(file, "close", None)):
                     close()
         finally:
@@ -8,9 +8,166 @@ __doc__ = "自定义请求函数"
 from collections.abc import Callable
 from functools import partial
 from http.cookiejar import CookieJar
+from importlib.util import find_spec
 from subprocess import run
 from sys import executable, modules
-from typing import Literal
+from typing import Final, Literal
+
+
+_FACTORIES: Final[dict[str, Callable[..., Callable]]] = {}
+
+
+def _register(name: str, /) -> Callable[[Callable], Callable]:
+    """注册 `make_request` 所用的工厂函数，各工厂函数内部按需导入所依赖的模块
+    """
+    def deco(fn: Callable, /) -> Callable:
+        _FACTORIES[name] = fn
+        return fn
+    return deco
+
+
+@_register("httpx")
+def _make_httpx(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    from httpx import Client, Cookies, Limits
+    from httpx_request import request_sync
+    if cookiejar is None:
+        cookies = None
+    else:
+        cookies = Cookies()
+        cookies.jar = cookiejar
+    if "session" not in request_kwargs:
+        # NOTE: 如果安装了 h2，则启用 HTTP/2，多个请求可复用同一个连接
+        request_kwargs["session"] = Client(cookies=cookies, http2=find_spec("h2") is not None, limits=Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=30))
+    return partial(request_sync, **request_kwargs)
+
+
+@_register("httpx_async")
+def _make_httpx_async(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    from httpx import AsyncClient, Cookies, Limits
+    from httpx_request import request_async
+    if cookiejar is None:
+        cookies = None
+    else:
+        cookies = Cookies()
+        cookies.jar = cookiejar
+    if "session" not in request_kwargs:
+        # NOTE: 如果安装了 h2，则启用 HTTP/2，多个请求可复用同一个连接
+        request_kwargs["session"] = AsyncClient(cookies=cookies, http2=find_spec("h2") is not None, limits=Limits(max_connections=128, max_keepalive_connections=64, keepalive_expiry=30))
+    return partial(request_async, **request_kwargs)
+
+
+@_register("requests")
+def _make_requests(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    try:
+        from requests import Session
+        from requests_request import request as requests_request
+    except ImportError:
+        run([executable, "-m", "pip", "install", "-U", "requests", "requests_request"], check=True)
+        from requests import Session
+        from requests_request import request as requests_request
+    session = request_kwargs.setdefault("session", Session())
+    if cookiejar is not None:
+        session.cookies.__dict__ = cookiejar.__dict__
+    return partial(requests_request, **request_kwargs)
+
+
+@_register("urllib3")
+def _make_urllib3(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    try:
+        from urllib3_request import __version__
+        if __version__ < (0, 0, 8):
+            modules.pop("urllib3_request", None)
+            raise ImportError
+        from urllib3.poolmanager import PoolManager
+        from urllib3_request import request as urllib3_request
+    except ImportError:
+        run([executable, "-m", "pip", "install", "-U", "urllib3", "urllib3_request>=0.0.8"], check=True)
+        from urllib3.poolmanager import PoolManager
+        from urllib3_request import request as urllib3_request
+    if cookiejar is not None:
+        request_kwargs["cookies"] = cookiejar
+    if "pool" not in request_kwargs:
+        request_kwargs["pool"] = PoolManager(128)
+    return partial(urllib3_request, **request_kwargs)
+
+
+@_register("urlopen")
+def _make_urlopen(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    # TODO: 需要实现连接池，扩展 urllib.request.AbstractHTTPHandler
+    try:
+        from urlopen import request as urlopen_request
+    except ImportError:
+        run([executable, "-m", "pip", "install", "-U", "python-urlopen"], check=True)
+        from urlopen import request as urlopen_request
+    return partial(urlopen_request, cookies=cookiejar)
+
+
+@_register("aiohttp")
+def _make_aiohttp(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    try:
+        from aiohttp_client_request import __version__
+        if __version__ < (0, 0, 4):
+            modules.pop("aiohttp_client_request", None)
+            raise ImportError
+        from aiohttp import ClientSession as AiohttpClientSession
+        from aiohttp_client_request import request as aiohttp_request
+    except ImportError:
+        run([executable, "-m", "pip", "install", "-U", "aiohttp", "aiohttp_client_request>=0.0.4"], check=True)
+        from aiohttp import ClientSession as AiohttpClientSession
+        from aiohttp_client_request import request as aiohttp_request
+    if cookiejar is not None:
+        request_kwargs["cookies"] = cookiejar
+    if "session" not in request_kwargs:
+        request_kwargs["session"] = AiohttpClientSession()
+    return partial(aiohttp_request, **request_kwargs)
+
+
+@_register("blacksheep")
+def _make_blacksheep(
+    cookiejar: None | CookieJar = None, 
+    /, 
+    **request_kwargs, 
+) -> Callable:
+    try:
+        from blacksheep_client_request import __version__
+        if __version__ < (0, 0, 4):
+            modules.pop("blacksheep_client_request", None)
+            raise ImportError
+        from blacksheep.client import ClientSession as BlacksheepClientSession
+        from blacksheep_client_request import request as blacksheep_request
+    except ImportError:
+        run([executable, "-m", "pip", "install", "-U", "blacksheep", "blacksheep_client_request>=0.0.4"], check=True)
+        from blacksheep.client import ClientSession as BlacksheepClientSession
+        from blacksheep_client_request import request as blacksheep_request
+    if cookiejar is not None:
+        request_kwargs["cookies"] = cookiejar
+    if "session" not in request_kwargs:
+        request_kwargs["session"] = BlacksheepClientSession()
+    return partial(blacksheep_request, **request_kwargs)
 
 
 def make_request(
@@ -27,104 +184,13 @@ def make_request(
 
     :return: 一个请求函数，可供 `P115Client.request` 使用，所以也可传给所有基于前者的 `P115Client` 的方法，作为 `request` 参数
     """
-    match module:
-        case "":
-            return None
-        case "httpx":
-            from httpx import Client, Cookies, Limits
-            from httpx_request import request_sync
-            if cookiejar is None:
-                cookies = None
-            else:
-                cookies = Cookies()
-                cookies.jar = cookiejar
-            if "session" not in request_kwargs:
-                request_kwargs["session"] = Client(cookies=cookies, limits=Limits(max_connections=128))
-            return partial(request_sync, **request_kwargs)
-        case "httpx_async":
-            from httpx import AsyncClient, Cookies, Limits
-            from httpx_request import request_async
-            if cookiejar is None:
-                cookies = None
-            else:
-                cookies = Cookies()
-                cookies.jar = cookiejar
-            if "session" not in request_kwargs:
-                request_kwargs["session"] = AsyncClient(cookies=cookies, limits=Limits(max_connections=128))
-            return partial(request_async, **request_kwargs)
-        case "requests":
-            try:
-                from requests import Session
-                from requests_request import request as requests_request
-            except ImportError:
-                run([executable, "-m", "pip", "install", "-U", "requests", "requests_request"], check=True)
-                from requests import Session
-                from requests_request import request as requests_request
-            session = request_kwargs.setdefault("session", Session())
-            if cookiejar is not None:
-                session.cookies.__dict__ = cookiejar.__dict__
-            return partial(requests_request, **request_kwargs)
-        case "urllib3":
-            try:
-                from urllib3_request import __version__
-                if __version__ < (0, 0, 8):
-                    modules.pop("urllib3_request", None)
-                    raise ImportError
-                from urllib3.poolmanager import PoolManager
-                from urllib3_request import request as urllib3_request
-            except ImportError:
-                run([executable, "-m", "pip", "install", "-U", "urllib3", "urllib3_request>=0.0.8"], check=True)
-                from urllib3.poolmanager import PoolManager
-                from urllib3_request import request as urllib3_request
-            if cookiejar is not None:
-                request_kwargs["cookies"] = cookiejar
-            if "pool" not in request_kwargs:
-                request_kwargs["pool"] = PoolManager(128)
-            return partial(urllib3_request, **request_kwargs)
-        case "urlopen":
-            # TODO: 需要实现连接池，扩展 urllib.request.AbstractHTTPHandler
-            try:
-                from urlopen import request as urlopen_request
-            except ImportError:
-                run([executable, "-m", "pip", "install", "-U", "python-urlopen"], check=True)
-                from urlopen import request as urlopen_request
-            return partial(urlopen_request, cookies=cookiejar)
-        case "aiohttp":
-            try:
-                from aiohttp_client_request import __version__
-                if __version__ < (0, 0, 4):
-                    modules.pop("aiohttp_client_request", None)
-                    raise ImportError
-                from aiohttp import ClientSession as AiohttpClientSession
-                from aiohttp_client_request import request as aiohttp_request
-            except ImportError:
-                run([executable, "-m", "pip", "install", "-U", "aiohttp", "aiohttp_client_request>=0.0.4"], check=True)
-                from aiohttp import ClientSession as AiohttpClientSession
-                from aiohttp_client_request import request as aiohttp_request
-            if cookiejar is not None:
-                request_kwargs["cookies"] = cookiejar
-            if "session" not in request_kwargs:
-                request_kwargs["session"] = AiohttpClientSession()
-            return partial(aiohttp_request, **request_kwargs)
-        case "blacksheep":
-            try:
-                from blacksheep_client_request import __version__
-                if __version__ < (0, 0, 4):
-                    modules.pop("blacksheep_client_request", None)
-                    raise ImportError
-                from blacksheep.client import ClientSession as BlacksheepClientSession
-                from blacksheep_client_request import request as blacksheep_request
-            except ImportError:
-                run([executable, "-m", "pip", "install", "-U", "blacksheep", "blacksheep_client_request>=0.0.4"], check=True)
-                from blacksheep.client import ClientSession as BlacksheepClientSession
-                from blacksheep_client_request import request as blacksheep_request
-            if cookiejar is not None:
-                request_kwargs["cookies"] = cookiejar
-            if "session" not in request_kwargs:
-                request_kwargs["session"] = BlacksheepClientSession()
-            return partial(blacksheep_request, **request_kwargs)
-        case _:
-            raise ValueError(f"can't make request for {module!r}")
+    if not module:
+        return None
+    try:
+        factory = _FACTORIES[module]
+    except KeyError:
+        raise ValueError(f"can't make request for {module!r}") from None
+    return factory(cookiejar, **request_kwargs)
 
 # TODO: 基于 http.client 实现一个 request，并且支持连接池
 # TODO: 基于 https://asks.readthedocs.io/en/latest/ 实现一个 request